@@ -0,0 +1,183 @@
+# coding: utf-8
+"""
+Microbenchmarks for the parts of the pipeline that run most often:
+
+* getNextId: Dolores.getNextId, once per new connection.
+* fanout: Pig.update, sending one publish to every Firenze listening on its path.
+  The Firenzes have no connection, so what is timed is the dispatch and queueing.
+* processQueue: Firenze.processQueue, stitching a queue of encoded updates into a
+  response.
+* gone: tearing down 10000 sessions, one ::gone each (Dolores.unregisterThestral) or
+  STOP_BATCH to a ::gone (Dolores.unregisterThestrals, as FirenzeManager.stop does).
+  Afterwards, nothing should be left of their subscriptions.
+* slicedFanout: one publish to a path with 100000 listeners, all at once or through
+  a Fanout. What matters is the longest the event loop is kept busy in one pass,
+  which with a Fanout should stay near its BUDGET.
+
+Each prints the time per operation, the best of REPEAT runs, so that runs on the
+same machine can be compared.
+
+Usage: python benchmarks/micro.py [getNextId] [fanout] [processQueue] [gone] [slicedFanout]
+"""
+import os
+import sys
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from dobby.dolores import Dolores
+from dobby.owl import Pig, Fanout
+from dobby.firenze import Firenze, FirenzeManager
+
+REPEAT = 5
+
+class QuietFirenze(Firenze):
+	"""
+	A Firenze with nowhere to send to: its timers and sends do nothing.
+	"""
+	def send(self, headers, data):
+		pass
+	
+	def finish(self):
+		pass
+	
+	def setTimeout(self, delay):
+		pass
+	
+	def setCancelTimeout(self, delay):
+		pass
+
+def best(run, number):
+	"""
+	Returns the best time per operation of REPEAT calls to run(number).
+	"""
+	times = []
+	for i in range(REPEAT):
+		start = time()
+		run(number)
+		times.append(time() - start)
+	return min(times) / number
+
+def report(name, seconds, note="", unit="us/op"):
+	print "%-34s %10.2f %s %s" % (name, seconds * 1e6, unit, note)
+
+def benchGetNextId():
+	dolores = Dolores()
+	def run(number):
+		getNextId = dolores.getNextId
+		for i in xrange(number):
+			getNextId()
+	report("Dolores.getNextId", best(run, 20000))
+
+def benchFanout():
+	for listeners in (1, 100, 10000):
+		dolores = Dolores()
+		pig = Pig(dolores)
+		dolores.delegate(pig)
+		manager = FirenzeManager(dolores)
+		firenzes = []
+		for i in range(listeners):
+			firenze = QuietFirenze(manager)
+			dolores.registerThestral(firenze)
+			pig.connect(firenze.id, firenze, "bench")
+			firenzes.append(firenze)
+		
+		def run(number):
+			for firenze in firenzes:
+				firenze.confirm(len(firenze.queue))
+			for i in xrange(number):
+				pig.update(dolores, "bench", "message %d" % i)
+		
+		seconds = best(run, max(10, 100000 // listeners))
+		report("Pig.update (%d listeners)" % listeners, seconds,
+			"(%.3f us per listener)" % (seconds * 1e6 / listeners))
+
+def benchProcessQueue():
+	dolores = Dolores()
+	manager = FirenzeManager(dolores)
+	for queued in (0, 10, 100):
+		firenze = QuietFirenze(manager)
+		dolores.registerThestral(firenze)
+		for i in range(queued):
+			firenze.enqueue("bench", manager.encode("bench", "message %d" % i))
+		
+		def run(number):
+			processQueue = firenze.processQueue
+			for i in xrange(number):
+				firenze.isReadyToSend = True
+				processQueue()
+		
+		report("Firenze.processQueue (%d queued)" % queued, best(run, 20000))
+
+def benchGone():
+	sessions = 10000
+	for bulk in (False, True):
+		dolores = Dolores()
+		pig = Pig(dolores)
+		dolores.delegate(pig)
+		manager = FirenzeManager(dolores)
+		firenzes = []
+		for i in range(sessions):
+			firenze = QuietFirenze(manager)
+			dolores.registerThestral(firenze)
+			pig.connect(firenze.id, firenze, "bench/%d" % i)
+			pig.connect(firenze.id, firenze, "bench/%d/*" % (i % 100))
+			firenzes.append(firenze)
+		
+		# Only one run: it tears everything down
+		start = time()
+		if bulk:
+			for i in xrange(0, sessions, manager.STOP_BATCH):
+				dolores.unregisterThestrals(firenzes[i:i + manager.STOP_BATCH])
+		else:
+			for firenze in firenzes:
+				dolores.unregisterThestral(firenze)
+		seconds = (time() - start) / sessions
+		
+		left = len(pig.protocols) + len(pig.listeners.exact) + len(pig.listeners.root.children)
+		report("::gone (%s)" % ("batched" if bulk else "one at a time"), seconds,
+			"(%d index entries left)" % left)
+
+def benchSlicedFanout():
+	listeners = 100000
+	for sliced in (False, True):
+		dolores = Dolores()
+		passes = []
+		fanout = Fanout(passes.append) if sliced else None
+		pig = Pig(dolores, fanout=fanout)
+		dolores.delegate(pig)
+		manager = FirenzeManager(dolores)
+		for i in range(listeners):
+			firenze = QuietFirenze(manager)
+			dolores.registerThestral(firenze)
+			pig.connect(firenze.id, firenze, "bench")
+		
+		# Run the passes the Fanout asks for, as the event loop would
+		start = time()
+		pig.update(dolores, "bench", "message")
+		longest = time() - start
+		count = 1
+		while passes:
+			begun = time()
+			passes.pop(0)()
+			longest = max(longest, time() - begun)
+			count += 1
+		report("Pig.update (%s)" % ("sliced" if sliced else "all at once"), longest,
+			"(%d passes)" % count, unit="us longest pass")
+
+BENCHMARKS = (
+	("getNextId", benchGetNextId),
+	("fanout", benchFanout),
+	("processQueue", benchProcessQueue),
+	("gone", benchGone),
+	("slicedFanout", benchSlicedFanout)
+)
+
+def main():
+	chosen = sys.argv[1:]
+	for name, bench in BENCHMARKS:
+		if not chosen or name in chosen:
+			bench()
+
+if __name__ == "__main__":
+	main()
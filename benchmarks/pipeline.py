@@ -0,0 +1,345 @@
+# coding: utf-8
+"""
+Load test of the whole push pipeline, over loopback: publishing through Dudley,
+dispatching with Pig (or Hedwig), and long polling from Firenze.
+
+The server runs in a child process (this script, run with "serve"), with the real
+TwistedFirenzeServer, TwistedDudleyServer and TwistedImperioServer (or, with
+--backend asyncio, their asyncio versions from portkey.py). This process:
+* opens CLIENTS long polls, each following reconnectWith as a browser would,
+* connects each one, over Imperio, to one of PATHS paths,
+* runs PUBLISHERS publishers, each posting RATE messages a second of SIZE bytes to
+  Dudley. Each message starts with the time it was sent.
+
+After WARMUP seconds of publishing, it measures for DURATION seconds:
+* latency: from publishing a message to a client receiving it,
+* messages published and delivered per second,
+* the server's CPU time per delivered message,
+* the server's RSS per connection (how much it grew opening the connections).
+
+Latency includes Firenze's DELAY_TRANSMISSION (--delay). All the clients run in
+this one process, so with many of them, check that it is the server that is busy.
+CPU and RSS are read from /proc, so they are only reported on Linux.
+
+Usage: python benchmarks/pipeline.py [options]  (--help lists them)
+"""
+import os
+import subprocess
+import sys
+from optparse import OptionParser
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from twisted.internet import reactor, task
+from twisted.internet.protocol import Protocol, ClientCreator
+from dobby.marauder import Histogram
+
+try:
+	import simplejson as json
+except:
+	import json
+
+def raiseFileLimit():
+	try:
+		import resource
+		soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+		resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+	except (ImportError, ValueError):
+		pass
+
+def serve(options):
+	"""
+	Runs the server, in the child process.
+	"""
+	from dobby.dolores import Dolores
+	from dobby.owl import Pig, Hedwig
+	from dobby.firenze import encodeUpdate
+	if options.backend == "asyncio":
+		from dobby.portkey import AsyncioFirenzeServer as FirenzeServer, \
+			AsyncioDudleyServer as DudleyServer, AsyncioImperioServer as ImperioServer
+	else:
+		from dobby.firenze import TwistedFirenzeServer as FirenzeServer
+		from dobby.dudley import TwistedDudleyServer as DudleyServer
+		from dobby.imperio import TwistedImperioServer as ImperioServer
+	
+	dolores = Dolores()
+	if options.hedwig:
+		dispatcher = Hedwig(dolores=dolores, encode=encodeUpdate)
+	else:
+		dispatcher = Pig(dolores=dolores)
+	dolores.delegate(dispatcher)
+	
+	FirenzeServer(dolores=dolores, port=options.port, log=dispatcher if options.hedwig else None,
+		DELAY_TRANSMISSION=options.delay, ADAPTIVE=options.adaptive)
+	DudleyServer(dolores=dolores, port=options.port + 1)
+	ImperioServer(dolores=dolores, port=options.port + 2)
+	
+	# The servers are listening by now, whichever loop will run them
+	sys.stdout.write("ready\n")
+	sys.stdout.flush()
+	dolores.start()
+
+class Process(object):
+	"""
+	Reads a process's CPU time and RSS from /proc.
+	"""
+	def __init__(self, pid):
+		self.pid = pid
+		self.ticks = float(os.sysconf("SC_CLK_TCK")) if hasattr(os, "sysconf") else 100.0
+	
+	def cpu(self):
+		try:
+			stat = open("/proc/%d/stat" % self.pid).read()
+		except IOError:
+			return None
+		fields = stat.rsplit(")", 1)[1].split()
+		return (int(fields[11]) + int(fields[12])) / self.ticks
+	
+	def rss(self):
+		try:
+			for line in open("/proc/%d/status" % self.pid):
+				if line.startswith("VmRSS:"):
+					return int(line.split()[1]) * 1024
+		except IOError:
+			pass
+		return None
+
+class HTTPRequest(Protocol):
+	"""
+	Sends one HTTP/1.0 request, and hands the body to callback once the server
+	closes the connection.
+	"""
+	def __init__(self, request, callback):
+		self.request = request
+		self.callback = callback
+		self.data = []
+	
+	def connectionMade(self):
+		self.transport.write(self.request)
+	
+	def dataReceived(self, data):
+		self.data.append(data)
+	
+	def connectionLost(self, reason):
+		self.callback("".join(self.data).split("\r\n\r\n", 1)[-1])
+
+class Client(object):
+	"""
+	A long-polling client, as a browser would be.
+	"""
+	def __init__(self, bench, path):
+		self.bench = bench
+		self.path = path
+		self.uid = None
+		self.subscribed = False
+		self.reconnectWith = ""
+	
+	def poll(self):
+		self.bench.request(self.bench.options.port, "GET /%s HTTP/1.0\r\n\r\n" % self.reconnectWith,
+			self.received)
+	
+	def received(self, body):
+		now = time()
+		bench = self.bench
+		try:
+			response = json.loads(body)
+		except ValueError:
+			bench.errors += 1
+			if bench.running:
+				reactor.callLater(.1, self.poll)
+			return
+		
+		for update in response["updates"]:
+			message = update["message"]
+			if message:
+				bench.delivered(now, float(message.split(" ", 1)[0]))
+			elif not self.subscribed:
+				# The empty message Pig sends on connecting
+				self.subscribed = True
+				bench.subscribed()
+		
+		self.reconnectWith = str(response["reconnectWith"])
+		if self.uid is None:
+			self.uid = self.reconnectWith.split("/")[0]
+			bench.joined(self)
+		if bench.running:
+			self.poll()
+
+class Bench(object):
+	def __init__(self, options, server):
+		self.options = options
+		self.server = server
+		self.running = True
+		self.measuring = False
+		self.errors = 0
+		self.clients = []
+		self.joinedCount = 0
+		self.subscribedCount = 0
+		self.published = 0
+		self.deliveries = 0
+		self.latency = Histogram()
+		self.publishers = []
+		self.sequence = 0
+		self.padding = "x" * options.size
+	
+	def request(self, port, data, callback):
+		connecting = ClientCreator(reactor, HTTPRequest, data, callback).connectTCP("127.0.0.1", port)
+		connecting.addErrback(self.failed, port, data, callback)
+	
+	def failed(self, reason, port, data, callback):
+		self.errors += 1
+		if self.running:
+			reactor.callLater(.1, self.request, port, data, callback)
+	
+	def start(self):
+		self.rssBefore = self.server.rss()
+		print "Opening %d long polls..." % self.options.clients
+		for i in range(self.options.clients):
+			client = Client(self, "bench/%d" % (i % self.options.paths))
+			self.clients.append(client)
+			client.poll()
+		reactor.callLater(self.options.timeout, self.timedOut)
+	
+	def timedOut(self):
+		if self.publishers:
+			return
+		print "Gave up: %d of %d clients joined, %d subscribed" % (
+			self.joinedCount, len(self.clients), self.subscribedCount)
+		self.stop()
+	
+	def joined(self, client):
+		self.joinedCount += 1
+		if self.joinedCount == len(self.clients):
+			print "Connecting them over Imperio..."
+			ClientCreator(reactor, Protocol).connectTCP("127.0.0.1", self.options.port + 2).addCallback(self.connect)
+	
+	def connect(self, imperio):
+		lines = []
+		for client in self.clients:
+			lines.append("::connect;%s->%s\r\n" % (client.uid, client.path))
+		imperio.transport.write("".join(lines))
+		imperio.transport.write("::exit\r\n")
+	
+	def subscribed(self):
+		self.subscribedCount += 1
+		if self.subscribedCount == len(self.clients):
+			self.rssAfter = self.server.rss()
+			self.startPublishing()
+	
+	def startPublishing(self):
+		options = self.options
+		print "Publishing (%d publishers, %g messages a second each) for %gs to warm up..." % (
+			options.publishers, options.rate, options.warmup)
+		for i in range(options.publishers):
+			publisher = task.LoopingCall(self.publish)
+			publisher.start(1.0 / options.rate, now=False)
+			self.publishers.append(publisher)
+		reactor.callLater(options.warmup, self.startMeasuring)
+	
+	def publish(self):
+		self.sequence += 1
+		path = "bench/%d" % (self.sequence % self.options.paths)
+		body = json.dumps([{"path": path, "message": "%.6f %s" % (time(), self.padding)}])
+		self.request(self.options.port + 1,
+			"POST / HTTP/1.0\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body),
+			self.publishCompleted)
+		if self.measuring:
+			self.published += 1
+	
+	def publishCompleted(self, body):
+		if "success" not in body:
+			self.errors += 1
+	
+	def delivered(self, now, sent):
+		if self.measuring and sent >= self.measureStart:
+			self.deliveries += 1
+			self.latency.record((now - sent) * 1e6)
+	
+	def startMeasuring(self):
+		print "Measuring for %gs..." % self.options.duration
+		self.measuring = True
+		self.measureStart = time()
+		self.cpuStart = self.server.cpu()
+		reactor.callLater(self.options.duration, self.stopMeasuring)
+	
+	def stopMeasuring(self):
+		self.measuring = False
+		elapsed = time() - self.measureStart
+		cpu = self.server.cpu()
+		self.report(elapsed, cpu - self.cpuStart if cpu is not None else None)
+		self.stop()
+	
+	def report(self, elapsed, cpu):
+		options = self.options
+		latency = self.latency.snapshot()
+		print
+		print "clients %d, paths %d, publishers %d at %g/s, %d byte messages, delay %gs, %s%s%s" % (
+			options.clients, options.paths, options.publishers, options.rate, options.size, options.delay,
+			options.backend, ", Hedwig" if options.hedwig else "", ", adaptive" if options.adaptive else "")
+		print "published:  %10.1f messages/s" % (self.published / elapsed)
+		print "delivered:  %10.1f messages/s" % (self.deliveries / elapsed)
+		if latency["count"]:
+			print "latency:    p50 %.1fms  p90 %.1fms  p99 %.1fms  p99.9 %.1fms  max %.1fms" % tuple(
+				latency[p] / 1000.0 for p in ("p50", "p90", "p99", "p99.9", "max"))
+		if cpu is not None and self.deliveries:
+			print "server CPU: %10.1f us per delivered message (%.0f%% of a core)" % (
+				cpu / self.deliveries * 1e6, cpu / elapsed * 100)
+		if self.rssBefore and self.rssAfter:
+			print "server RSS: %10.1f KB per connection (%.1f MB in all)" % (
+				(self.rssAfter - self.rssBefore) / 1024.0 / len(self.clients), self.rssAfter / 1048576.0)
+		print "errors:     %10d" % self.errors
+	
+	def stop(self):
+		self.running = False
+		for publisher in self.publishers:
+			publisher.stop()
+		reactor.stop()
+
+def parseOptions():
+	parser = OptionParser(usage="%prog [serve] [options]")
+	parser.add_option("--clients", type="int", default=1000, help="long-polling clients [%default]")
+	parser.add_option("--paths", type="int", default=10, help="paths the clients are spread over [%default]")
+	parser.add_option("--publishers", type="int", default=4, help="publishers [%default]")
+	parser.add_option("--rate", type="float", default=10, help="messages a second per publisher [%default]")
+	parser.add_option("--size", type="int", default=100, help="message size in bytes [%default]")
+	parser.add_option("--duration", type="float", default=10, help="seconds to measure for [%default]")
+	parser.add_option("--warmup", type="float", default=2, help="seconds to publish before measuring [%default]")
+	parser.add_option("--delay", type="float", default=.25, help="Firenze's DELAY_TRANSMISSION [%default]")
+	parser.add_option("--adaptive", action="store_true", help="batch adaptively (see firenze.py)")
+	parser.add_option("--hedwig", action="store_true", help="dispatch with Hedwig rather than Pig")
+	parser.add_option("--backend", choices=("twisted", "asyncio"), default="twisted",
+		help="the server's backend: twisted or asyncio [%default]")
+	parser.add_option("--port", type="int", default=9008,
+		help="Firenze's port; Dudley and Imperio take the next two [%default]")
+	parser.add_option("--timeout", type="float", default=60, help="seconds to wait for clients to connect [%default]")
+	return parser.parse_args()
+
+def main():
+	options, args = parseOptions()
+	raiseFileLimit()
+	if args and args[0] == "serve":
+		serve(options)
+		return
+	
+	options.paths = min(options.paths, options.clients)
+	command = [sys.executable, os.path.abspath(__file__), "serve"] + sys.argv[1:]
+	child = subprocess.Popen(command, stdout=subprocess.PIPE)
+	try:
+		while True:
+			line = child.stdout.readline()
+			if not line:
+				print "The server did not start."
+				return
+			if line.strip() == "ready":
+				break
+		
+		bench = Bench(options, Process(child.pid))
+		reactor.callWhenRunning(bench.start)
+		reactor.run()
+	finally:
+		child.terminate()
+		child.wait()
+
+if __name__ == "__main__":
+	main()
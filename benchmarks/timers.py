@@ -0,0 +1,79 @@
+# coding: utf-8
+"""
+Compares the TimingWheel that FirenzeManager uses against a reactor.callLater
+per Firenze, the way TwistedFirenze used to schedule its timers.
+
+Each simulated connection does what a Firenze does on a poll followed by a few
+messages: cancel and schedule its cancel timer, then cancel and schedule its
+send timer once per message. At the end, every remaining timer is made due and
+fired.
+
+Usage: python benchmarks/timers.py [connections] [messages per connection]
+"""
+import os
+import sys
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from twisted.internet import reactor
+from dobby.firenze import TimingWheel
+
+def noop():
+	pass
+
+def churn(callLater, connections, messages):
+	timeouts = [None] * connections
+	cancels = [None] * connections
+	for i in range(connections):
+		cancels[i] = callLater(30, noop)
+	for m in range(messages):
+		for i in range(connections):
+			if cancels[i]:
+				cancels[i].cancel()
+				cancels[i] = None
+			if timeouts[i]:
+				timeouts[i].cancel()
+			timeouts[i] = callLater(.25, noop)
+	return timeouts
+
+def benchReactor(connections, messages):
+	start = time()
+	churn(reactor.callLater, connections, messages)
+	scheduled = time() - start
+	
+	# Make everything due, then fire it the way the reactor would
+	later = reactor.seconds() + 60
+	realSeconds = reactor.seconds
+	reactor.seconds = lambda: later
+	start = time()
+	reactor.runUntilCurrent()
+	fired = time() - start
+	reactor.seconds = realSeconds
+	return scheduled, fired
+
+def benchWheel(connections, messages):
+	clock = [time()]
+	wheel = TimingWheel(TICK=.05, now=lambda: clock[0])
+	start = time()
+	churn(wheel.schedule, connections, messages)
+	scheduled = time() - start
+	
+	clock[0] += 60
+	start = time()
+	wheel.advance()
+	fired = time() - start
+	return scheduled, fired
+
+def main():
+	connections = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+	messages = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+	operations = connections * (messages * 2 + 1)
+	print "%d connections, %d messages each (%d schedules and cancels)" % (connections, messages, operations)
+	for name, bench in (("reactor.callLater", benchReactor), ("TimingWheel", benchWheel)):
+		scheduled, fired = bench(connections, messages)
+		print "%-18s schedule+cancel: %7.3fs (%6.2f us/op)   fire: %7.3fs" % (
+			name, scheduled, scheduled / operations * 1e6, fired)
+
+if __name__ == "__main__":
+	main()
@@ -1,18 +1,96 @@
 # You know that Dobby and the Hufflepuffs secretly control the world,
 # right? Don't tell them I told you. They'll come after me.
 
+import os
 from dobby.dolores import Dolores
-from dobby.imperio import Logger, TwistedImperioServer, TwistedHTTPImperioServer
-from dobby.firenze import TwistedFirenzeServer
-from dobby.dudley import TwistedDudleyServer
-from dobby.owl import Pig
+from dobby.skeeter import Skeeter
+from dobby.marauder import MaraudersMap
+from dobby.firenze import encodeUpdate
+from dobby.owl import Pig, Hedwig, Fanout
+from dobby.gringotts import Gringotts
+from dobby.remembrall import Remembrall
+
+# The servers run on "twisted", or on "asyncio": trollius, that is, asyncio's
+# backport to Python 2 (see dobby/portkey.py). Everything else is the same.
+BACKEND = "twisted"
+
+if BACKEND == "asyncio":
+	from dobby.portkey import AsyncioImperioServer as ImperioServer, \
+		AsyncioHTTPImperioServer as HTTPImperioServer, AsyncioFlooServer as FlooServer, \
+		AsyncioMarauderServer as MarauderServer, AsyncioPensieve as PensieveClass, \
+		AsyncioFirenzeServer as FirenzeServer, AsyncioDudleyServer as DudleyServer, callEvery, callSoon
+else:
+	from dobby.imperio import TwistedImperioServer as ImperioServer, \
+		TwistedHTTPImperioServer as HTTPImperioServer
+	from dobby.floo import TwistedFlooServer as FlooServer
+	from dobby.marauder import TwistedMarauderServer as MarauderServer
+	from dobby.pensieve import TwistedPensieve as PensieveClass
+	from dobby.firenze import TwistedFirenzeServer as FirenzeServer
+	from dobby.dudley import TwistedDudleyServer as DudleyServer
+	from twisted.internet import reactor, task
+	
+	def callEvery(interval, function):
+		task.LoopingCall(function).start(interval, now=False)
+	
+	def callSoon(function):
+		reactor.callLater(0, function)
+
+# Set to True to use Hedwig, the queued dispatcher, instead of Pig. Hedwig keeps
+# one log per path that all Firenzes read from, instead of a queue per Firenze.
+USE_HEDWIG = False
+
+# With Hedwig, set to a directory to keep a journal of every update there. Then
+# clients whose session timed out, or who were connected before a restart, are
+# sent what they missed rather than having to start over.
+JOURNAL_DIRECTORY = None
+
+# Set to True to remember the latest message on each path (within bounds; see
+# dobby/remembrall.py), and confirm connects to a path with it instead of an
+# empty message, so clients needn't ask the backend for the current state.
+USE_CACHE = False
+
+# Updates to paths with FANOUT_THRESHOLD listeners or more are delivered a slice
+# at a time, spending no more than FANOUT_BUDGET seconds per pass of the event
+# loop, so that publishing to a huge path doesn't stall every other request.
+FANOUT_THRESHOLD = 1000
+FANOUT_BUDGET = .005
+
+# Set to False to measure nothing. The measurements are served as JSON on
+# localhost:8009 (and by the workers, if any, on 8010, 8011, and so on).
+USE_METRICS = True
+
+# Set to more than 1 to use that many cores (with the "twisted" backend only):
+# this process, the Owlery, then takes the publishes (from Imperio, Dudley and
+# Floo), and passes them to that many worker processes, which all serve Firenze
+# on port 8008. They talk over UNIX sockets in OWLERY_DIRECTORY. See
+# dobby/owlery.py.
+WORKERS = 1
+OWLERY_DIRECTORY = "/tmp/dobby-owlery"
+
+# The worker this process is (set by the Owlery), or None
+WORKER = int(os.environ["DOBBY_WORKER"]) if "DOBBY_WORKER" in os.environ else None
+if WORKERS > 1:
+	if BACKEND != "twisted":
+		raise ValueError("Only the twisted backend runs workers")
+	from dobby.owlery import workerId, TwistedOwleryServer, TwistedOwleryClientFactory, \
+		TwistedOwleryFirenzeServer
+
+# Whether this process takes publishes, and whether it serves sessions
+TAKES_PUBLISHES = WORKER is None
+SERVES_SESSIONS = WORKERS == 1 or WORKER is not None
 
 # Dolores: the controller
-DOLORES = Dolores()
+METRICS = MaraudersMap() if USE_METRICS else None
+DOLORES = Dolores(id=workerId(WORKER) if WORKER is not None else "DOLORES-SERVER", metrics=METRICS,
+	callSoon=callSoon)
 
-# Logger: logs everything Dolores receives to command line.
-LOGGER = Logger()
-DOLORES.delegate(LOGGER)
+# Skeeter: logs everything Dolores receives to command line, from her own
+# thread. (Logger, from imperio, does the same while Dolores waits; delegate
+# it, or anything else slow, with deferred=True to keep it from holding up the
+# dispatcher.)
+if TAKES_PUBLISHES:
+	LOGGER = Skeeter()
+	DOLORES.delegate(LOGGER)
 
 # Imperio: Controlling Connections from port 8007
 # WARNING WARNING WARNING!!! Whatever port the Imperio server uses
@@ -24,17 +102,74 @@ DOLORES.delegate(LOGGER)
 #   to, and have it skip any commands that should not be listened to.
 
 # Dispatcher: connects, dispatches events. blah.
-DISPATCHER = Pig(dolores=DOLORES)
-DOLORES.delegate(DISPATCHER)
+if SERVES_SESSIONS:
+	CACHE = Remembrall() if USE_CACHE else None
+	FANOUT = Fanout(callSoon, THRESHOLD=FANOUT_THRESHOLD, BUDGET=FANOUT_BUDGET)
+	if CACHE is not None:
+		callEvery(5 * 60, CACHE.prune)
+	if USE_HEDWIG:
+		if JOURNAL_DIRECTORY and WORKER is not None:
+			# Each worker keeps its own
+			JOURNAL_DIRECTORY = os.path.join(JOURNAL_DIRECTORY, str(WORKER))
+		JOURNAL = Gringotts(JOURNAL_DIRECTORY) if JOURNAL_DIRECTORY else None
+		if JOURNAL:
+			# Drop what is too old even from paths nobody writes to any more
+			callEvery(60 * 60, JOURNAL.prune)
+		DISPATCHER = Hedwig(dolores=DOLORES, encode=encodeUpdate, journal=JOURNAL, cache=CACHE, fanout=FANOUT)
+	else:
+		DISPATCHER = Pig(dolores=DOLORES, cache=CACHE, fanout=FANOUT)
+	DOLORES.delegate(DISPATCHER)
+	
+	# Pensieve: traces and profiles, when told to by an update (say, from Imperio):
+	# ::trace;0.01, ::trace-dump;file, or ::profile;10 (see dobby/pensieve.py)
+	PENSIEVE = PensieveClass(dolores=DOLORES)
+	DOLORES.delegate(PENSIEVE)
+	
+	# Firenze
+	if WORKER is not None:
+		FIRENZE_SERVER = TwistedOwleryFirenzeServer(dolores=DOLORES, worker=WORKER, directory=OWLERY_DIRECTORY,
+			log=DISPATCHER if USE_HEDWIG else None)
+	else:
+		FIRENZE_SERVER = FirenzeServer(dolores=DOLORES, log=DISPATCHER if USE_HEDWIG else None)
+else:
+	DISPATCHER = None
 
-# Firenze
-FIRENZE_SERVER = TwistedFirenzeServer(dolores=DOLORES)
+# The Owlery, and the workers' connections to it
+if WORKERS > 1 and WORKER is None:
+	OWLERY = TwistedOwleryServer(dolores=DOLORES, directory=OWLERY_DIRECTORY, WORKERS=WORKERS)
+elif WORKER is not None:
+	OWLERY = TwistedOwleryClientFactory(dolores=DOLORES, worker=WORKER, directory=OWLERY_DIRECTORY)
 
-# Imperio text-based protocol (and its HTTP version)
-IMPERIO = TwistedImperioServer(dolores=DOLORES, receiver=DOLORES)
-IMPERIOHTTP = TwistedHTTPImperioServer(dolores=DOLORES, receiver=DOLORES)
+if TAKES_PUBLISHES:
+	# Imperio text-based protocol (and its HTTP version)
+	IMPERIO = ImperioServer(dolores=DOLORES, receiver=DOLORES)
+	IMPERIOHTTP = HTTPImperioServer(dolores=DOLORES, receiver=DOLORES)
+	
+	# Floo: framed, binary Imperio for busy backends (port 8005). The same warning
+	# as for Imperio applies.
+	FLOO = FlooServer(dolores=DOLORES, receiver=DOLORES)
+	
+	# Dudley HTTP message receiver (kinda like a better Imperio HTTP). It also answers
+	# GET /?path=a&path=b with how many listeners each path has (unless the
+	# workers have them).
+	DUDLEY = DudleyServer(dolores=DOLORES, receiver=DOLORES, interest=DISPATCHER)
 
-# Dudley HTTP message receiver (kinda like a better Imperio HTTP)
-DUDLEY = TwistedDudleyServer(dolores=DOLORES, receiver=DOLORES)
+# The Marauder's Map: metrics
+if METRICS:
+	METRICS.watch("delegates", DOLORES.snapshot)
+	if TAKES_PUBLISHES:
+		METRICS.watch("log_dropped", lambda: LOGGER.dropped)
+	if SERVES_SESSIONS:
+		METRICS.watch("connections", lambda: len(DOLORES.thestrals))
+		METRICS.watch("subscriptions", DISPATCHER.countSubscriptions)
+		METRICS.watch("fanout", FANOUT.snapshot)
+		if CACHE is not None:
+			METRICS.watch("cache", CACHE.snapshot)
+		if USE_HEDWIG and JOURNAL:
+			METRICS.watch("journal_errors", lambda: DISPATCHER.journalErrors)
+		FIRENZE_SERVER.manager.watch(METRICS)
+		METRICS.watch("tracing", PENSIEVE.snapshot)
+	MARAUDER = MarauderServer(dolores=DOLORES, metrics=METRICS,
+		port=8009 if WORKER is None else 8010 + WORKER)
 
-DOLORES.start()
\ No newline at end of file
+DOLORES.start()
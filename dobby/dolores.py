@@ -2,6 +2,70 @@
 from thestral import Thestral
 import string
 import random
+import traceback
+from collections import deque
+from time import time
+
+try:
+	import simplejson as json
+except:
+	import json
+
+class DoloresQueue(object):
+	"""
+	Stands in for a deferred delegate (see Dolores.delegate). It queues the updates
+	for it, up to MAX_QUEUE (past that, they are dropped and counted), and hands
+	them over in batches of up to BATCH, each once the current pass of the event
+	loop is over.
+	"""
+	def __init__(self, dolores, thestral, name, MAX_QUEUE=10000, BATCH=500):
+		self.dolores = dolores
+		self.thestral = thestral
+		self.name = name
+		self.MAX_QUEUE = MAX_QUEUE
+		self.BATCH = BATCH
+		
+		# (when it was queued, sender, path, message)
+		self.queue = deque()
+		self.scheduled = False
+		self.dropped = 0
+	
+	def update(self, sender, path, message):
+		queue = self.queue
+		if len(queue) >= self.MAX_QUEUE:
+			self.dropped += 1
+			return
+		queue.append((time(), sender, path, message))
+		if not self.scheduled:
+			self.scheduled = True
+			self.dolores.callSoon(self.drain)
+	
+	def drain(self):
+		queue = self.queue
+		thestral = self.thestral
+		dolores = self.dolores
+		if queue and dolores.metrics:
+			# How long the oldest of the batch waited
+			dolores.metrics.recordTime(self.name + "_lag", time() - queue[0][0])
+		for i in xrange(min(len(queue), self.BATCH)):
+			queued, sender, path, message = queue.popleft()
+			try:
+				thestral.update(sender, path, message)
+			except Exception:
+				dolores.failed(thestral)
+		
+		self.scheduled = False
+		if queue:
+			self.scheduled = True
+			dolores.callSoon(self.drain)
+	
+	def lag(self):
+		"""
+		How long the oldest update still queued has waited.
+		"""
+		if self.queue:
+			return time() - self.queue[0][0]
+		return 0
 
 # Dolores is a server implementation of the Thestral protocol.
 class Dolores(Thestral):
@@ -11,15 +75,29 @@ class Dolores(Thestral):
 	Management of who is allowed to send what (like CONTROL priviledge) is handled through
 	the caretaker, Filch (not implemented yet). Or some other delegate, if you'd prefer.
 	"""
-	def __init__(self, id="DOLORES-SERVER"):
+	def __init__(self, id="DOLORES-SERVER", metrics=None, callSoon=None):
 		"""
 		Initializes the Dolores server manager.
+		
+		metrics, if given, is a MaraudersMap (see marauder.py); anything that
+		has Dolores measures what it does there.
+		
+		callSoon(function), if given, calls function once the current pass of the
+		event loop is over. Deferred delegates need it.
 		"""
 		self.id = id
+		self.metrics = metrics
+		self.callSoon = callSoon
 		self.currentIndex = 0
 		self.thestrals = {}
 		self.starters = set()
 		self.listeners = []
+		
+		# For each delegate: its name, how many of its updates failed, and (if it
+		# is deferred) its DoloresQueue
+		self.names = {}
+		self.errors = {}
+		self.queues = {}
 	
 	def update(self, sender, path, message):
 		"""
@@ -27,11 +105,70 @@ class Dolores(Thestral):
 		
 		Sender is the original sender.
 		"""
+		metrics = self.metrics
+		if not metrics:
+			for i in self.listeners:
+				try:
+					i.update(sender, path, message)
+				except Exception:
+					self.failed(i)
+			return
+		
+		start = time()
 		for i in self.listeners:
-			i.update(sender, path, message)
+			try:
+				i.update(sender, path, message)
+			except Exception:
+				self.failed(i)
+		metrics.recordDispatch(path, time() - start)
+	
+	def delegate(self, toWho, deferred=False, name=None, **options):
+		"""
+		Has toWho sent every update Dolores gets.
+		
+		Inline delegates (the default) are updated right away, in the order they
+		were delegated to. Deferred ones (say, a logger, or a relay to elsewhere)
+		are updated through a DoloresQueue (options are its MAX_QUEUE and BATCH),
+		so they can't slow down the inline ones. Either way, an exception from
+		one delegate is printed and counted, and the others are still updated.
+		
+		name is what the delegate is called in snapshot(); by default, its class.
+		"""
+		self.names[toWho] = name or toWho.__class__.__name__
+		self.errors[toWho] = 0
+		if not deferred:
+			self.listeners.append(toWho)
+			return
+		if not self.callSoon:
+			raise ValueError("Deferred delegates need Dolores to be given callSoon")
+		queue = self.queues[toWho] = DoloresQueue(self, toWho, self.names[toWho], **options)
+		self.listeners.append(queue)
+	
+	def failed(self, delegate):
+		"""
+		Called when a delegate raised an exception while being updated.
+		"""
+		if isinstance(delegate, DoloresQueue):
+			delegate = delegate.thestral
+		self.errors[delegate] = self.errors.get(delegate, 0) + 1
+		traceback.print_exc()
 	
-	def delegate(self, toWho):
-		self.listeners.append(toWho)
+	def snapshot(self):
+		"""
+		For the Marauder's Map: for each delegate, how many of its updates failed,
+		and for deferred ones, how many are queued, how many were dropped, and how
+		long the oldest queued one has waited.
+		"""
+		delegates = {}
+		for delegate, name in self.names.items():
+			info = {"errors": self.errors.get(delegate, 0)}
+			queue = self.queues.get(delegate)
+			if queue is not None:
+				info["queued"] = len(queue.queue)
+				info["dropped"] = queue.dropped
+				info["lag"] = queue.lag()
+			delegates[name] = info
+		return delegates
 	
 	def start(self):
 		"""
@@ -91,4 +228,20 @@ class Dolores(Thestral):
 		if thestral.id in self.thestrals:
 			del self.thestrals[thestral.id]
 			self.update(self, "::gone", thestral.id)
+	
+	def unregisterThestrals(self, thestrals):
+		"""
+		Unregisters many Thestrals at once, sending a single ::gone whose message
+		is a JSON list of their ids (or just the id, if there is only one).
+		"""
+		registered = self.thestrals
+		gone = []
+		for thestral in thestrals:
+			if thestral.id in registered:
+				del registered[thestral.id]
+				gone.append(thestral.id)
+		if len(gone) == 1:
+			self.update(self, "::gone", gone[0])
+		elif gone:
+			self.update(self, "::gone", json.dumps(gone))
 		
\ No newline at end of file
@@ -12,32 +12,77 @@ from twisted.internet import reactor, task
 from twisted.protocols.basic import LineReceiver
 from twisted.web import server, resource
 
+def receiveCommands(dolores, sender, content):
+	"""
+	Sends Dolores the commands in content, a JSON list of commands, each one of:
+	
+	{"path": "some/path", "message": "..."}
+	{"connect": {"uid": ["path", ...], ...}}  (or a list of [uid, path] pairs)
+	{"latest": {"uid": ["path", ...], ...}}
+	{"disconnect": {"uid": ["path", ...], ...}}
+	
+	Each connect, latest or disconnect command goes to Dolores as a single update,
+	however many uids and paths it holds. Returns the response for the sender.
+	"""
+	try:
+		commands = json.loads(content)
+		for c in commands:
+			if "message" in c and "path" in c:
+				dolores.update(sender, c["path"], c["message"])
+			elif "connect" in c:
+				dolores.update(sender, "::connect", json.dumps(c["connect"]))
+			elif "latest" in c:
+				dolores.update(sender, "::latest", json.dumps(c["latest"]))
+			elif "disconnect" in c:
+				dolores.update(sender, "::disconnect", json.dumps(c["disconnect"]))
+		return "{success:true}"
+	except:
+		return "{error:true}"
+
+def countInterest(interest, paths):
+	"""
+	Answers a query of how many listeners updates to each of the paths would
+	reach, as a JSON object of path to count. interest is the dispatcher (see
+	Pig.countListeners); without one, nothing is known.
+	"""
+	if not interest:
+		return "{}"
+	return json.dumps(interest.countListeners(paths))
+
 class TwistedDudleyResource(resource.Resource):
+	"""
+	Takes a POST of a JSON list of commands; see receiveCommands.
+	
+	A GET with path arguments (/?path=contacts&path=groups) asks how many
+	listeners each path has; see countInterest.
+	"""
 	isLeaf = True
-	def __init__(self, dolores, receiver):
+	def __init__(self, dolores, receiver, interest=None):
 		self.dolores = dolores
 		self.receiver = receiver
+		self.interest = interest
 	
 	def render_POST(self, request):
-		try:
-			request.content.seek(0, 0)
-			content = request.content.read()
-			commands = json.loads(content)
-			for c in commands:
-				if "message" in c and "path" in c:
-					self.dolores.update(self, c["path"], c["message"])
-			return "{success:true}"
-		except:
-			return "{error:true}"
+		request.content.seek(0, 0)
+		return receiveCommands(self.dolores, self, request.content.read())
+	
+	def render_GET(self, request):
+		request.setHeader("Content-Type", "application/json")
+		return countInterest(self.interest, request.args.get("path", []))
 
 class TwistedDudleyServer(object):
-	def __init__(self, dolores, receiver=None, host="localhost", port=8004):
+	def __init__(self, dolores, receiver=None, host="localhost", port=8004, interest=None):
+		"""
+		interest, if given, is the dispatcher, which answers GETs about who
+		listens to what.
+		"""
 		self.dolores = dolores
 		if not receiver: receiver = dolores
 		self.receiver = receiver
 		self.host = host
 		self.port = port
+		self.interest = interest
 		
-		self.site = server.Site(TwistedDudleyResource(self.dolores, self.receiver))
+		self.site = server.Site(TwistedDudleyResource(self.dolores, self.receiver, self.interest))
 		reactor.listenTCP(self.port, self.site)
 		dolores.addStarter(reactor.run)
\ No newline at end of file
@@ -0,0 +1,424 @@
+# coding: utf-8
+"""
+Errol carries updates from a backend (say, each Django worker) to Dobby.
+
+He never keeps the caller waiting: update() only puts the update in a buffer, and
+returns. A flush thread takes what has been buffered, FLUSH_INTERVAL seconds after
+the oldest of it arrived (or as soon as MAX_BATCH updates or MAX_BATCH_BYTES are
+waiting), and hands it to a pool of POOL_SIZE persistent connections, each with a
+thread of its own to send on it. Updates to the same path always go over the same
+connection, so they arrive in the order they were made. So do connects, latests and
+disconnects for it: one naming paths that go over different connections is split
+between them. (Only its own paths, though: a connect to a pattern is not kept in
+order with updates to the paths it matches.)
+
+The buffer holds at most MAX_BUFFER updates. If Dobby is slow or away and it fills
+up, further updates are dropped (and counted in dropped) rather than blocking.
+
+Updates may be fire-and-forget (update(), which returns whether the update was
+buffered), or acked (send(), which returns a Receipt to wait on). A batch counts as
+delivered once Dobby has answered for it; batches that fail are retried RETRIES times,
+reconnecting in between.
+
+Errol can talk to:
+* "dudley" (port 8004): a keep-alive HTTP POST of JSON per batch.
+* "imperio" (port 8003): a keep-alive HTTP POST of Imperio lines per batch. As with
+  Imperio anywhere, paths and messages can't hold ";" or newlines.
+* "floo" (port 8005): Floo frames over one socket, with a sync frame per batch;
+  Dobby's ack answers for the batch.
+
+For example:
+	from dobby.errol import Errol
+	ERROL = Errol()
+	ERROL.connect(uid, ["contacts"])
+	ERROL.update("contacts", json.dumps(contact))
+"""
+import atexit
+import httplib
+import Queue
+import socket
+import threading
+import zlib
+from collections import deque
+from time import time, sleep
+from floopowder import encodeUpdate, encodeSync, HEADER, SEQUENCE, ACK
+from owl import parseConnections
+
+try:
+	import simplejson as json
+except:
+	import json
+
+PORTS = {"dudley": 8004, "imperio": 8003, "floo": 8005}
+
+# Commands that are split by path, like updates
+ROUTED = frozenset(("::connect", "::latest", "::disconnect"))
+
+class ErrolError(Exception):
+	pass
+
+class Receipt(object):
+	"""
+	Returned by send(). delivered is None until Dobby answers (or Errol gives up),
+	then True or False.
+	"""
+	def __init__(self):
+		self.delivered = None
+		self.event = threading.Event()
+		
+		# A command split between connections is only delivered once every part is
+		self.parts = 1
+		self.succeeded = True
+	
+	def done(self, delivered):
+		self.parts -= 1
+		self.succeeded = self.succeeded and delivered
+		if self.parts <= 0:
+			self.delivered = self.succeeded
+			self.event.set()
+	
+	def wait(self, timeout=None):
+		"""
+		Waits for the update to be delivered; returns whether it was.
+		"""
+		self.event.wait(timeout)
+		return bool(self.delivered)
+
+class DudleyTransport(object):
+	def __init__(self, host, port, timeout):
+		self.connection = httplib.HTTPConnection(host, port, timeout=timeout)
+	
+	def send(self, updates):
+		body = json.dumps([{"path": path, "message": message} for path, message in updates])
+		self.connection.request("POST", "/", body, {"Content-Type": "application/json"})
+		response = self.connection.getresponse()
+		data = response.read()
+		if response.status != 200 or not "success" in data:
+			raise ErrolError(data)
+	
+	def close(self):
+		self.connection.close()
+
+class ImperioTransport(DudleyTransport):
+	def send(self, updates):
+		lines = []
+		for path, message in updates:
+			lines.append(path + ";" + message + "\n")
+		self.connection.request("POST", "/", "".join(lines))
+		response = self.connection.getresponse()
+		data = response.read()
+		if response.status != 200 or not "sent" in data:
+			raise ErrolError(data)
+
+class FlooTransport(object):
+	def __init__(self, host, port, timeout):
+		self.socket = socket.create_connection((host, port), timeout)
+		self.sequence = 0
+		self.buffer = ""
+	
+	def send(self, updates):
+		self.sequence = (self.sequence + 1) % 0x100000000
+		frames = [encodeUpdate(path, message) for path, message in updates]
+		frames.append(encodeSync(self.sequence))
+		self.socket.sendall("".join(frames))
+		while self.readAck() != self.sequence:
+			pass
+	
+	def readAck(self):
+		"""
+		Reads frames until an ack; returns its sequence number.
+		"""
+		while True:
+			while len(self.buffer) >= HEADER.size:
+				length, kind = HEADER.unpack_from(self.buffer)
+				if len(self.buffer) < 4 + length:
+					break
+				frame = self.buffer[HEADER.size:4 + length]
+				self.buffer = self.buffer[4 + length:]
+				if chr(kind) == ACK:
+					return SEQUENCE.unpack(frame)[0]
+			data = self.socket.recv(65536)
+			if not data:
+				raise ErrolError("connection closed")
+			self.buffer += data
+	
+	def close(self):
+		self.socket.close()
+
+TRANSPORTS = {"dudley": DudleyTransport, "imperio": ImperioTransport, "floo": FlooTransport}
+
+class ErrolSender(threading.Thread):
+	"""
+	Sends batches over one of Errol's connections.
+	"""
+	def __init__(self, errol, index):
+		threading.Thread.__init__(self, name="Errol-%d" % index)
+		self.daemon = True
+		self.errol = errol
+		self.batches = Queue.Queue(2)
+		self.transport = None
+	
+	def run(self):
+		while True:
+			batch = self.batches.get()
+			if batch is None:
+				break
+			self.deliver(batch)
+		if self.transport:
+			self.transport.close()
+	
+	def deliver(self, batch):
+		errol = self.errol
+		updates = [(path, message) for path, message, receipt in batch]
+		delivered = False
+		for attempt in range(errol.RETRIES + 1):
+			if attempt:
+				sleep(min(.1 * 2 ** attempt, 2))
+			try:
+				if not self.transport:
+					self.transport = errol.makeTransport()
+				self.transport.send(updates)
+				delivered = True
+				break
+			except (socket.error, httplib.HTTPException, ErrolError):
+				if self.transport:
+					self.transport.close()
+					self.transport = None
+		errol.delivered(batch, delivered)
+
+class Errol(object):
+	def __init__(self, transport="dudley", host="localhost", port=None, POOL_SIZE=2, FLUSH_INTERVAL=.05,
+			MAX_BATCH=500, MAX_BATCH_BYTES=256 * 1024, MAX_BUFFER=10000, RETRIES=3, TIMEOUT=5):
+		self.transport = transport
+		self.host = host
+		self.port = port or PORTS[transport]
+		self.FLUSH_INTERVAL = FLUSH_INTERVAL
+		self.MAX_BATCH = MAX_BATCH
+		self.MAX_BATCH_BYTES = MAX_BATCH_BYTES
+		self.MAX_BUFFER = MAX_BUFFER
+		self.RETRIES = RETRIES
+		self.TIMEOUT = TIMEOUT
+		
+		self.buffer = deque()
+		self.bufferBytes = 0
+		self.oldest = 0
+		self.pending = 0
+		self.closing = False
+		self.condition = threading.Condition()
+		
+		self.sent = 0
+		self.failed = 0
+		self.dropped = 0
+		
+		self.senders = [ErrolSender(self, i) for i in range(POOL_SIZE)]
+		for sender in self.senders:
+			sender.start()
+		self.thread = threading.Thread(target=self.run, name="Errol")
+		self.thread.daemon = True
+		self.thread.start()
+		atexit.register(self.close)
+	
+	def makeTransport(self):
+		return TRANSPORTS[self.transport](self.host, self.port, self.TIMEOUT)
+	
+	#
+	# Called by the backend
+	#
+	def update(self, path, message, receipt=None):
+		"""
+		Buffers an update for Dobby. Returns False if the buffer was full (or Errol
+		closed), in which case the update is dropped.
+		"""
+		if isinstance(path, unicode):
+			path = path.encode("utf-8")
+		if isinstance(message, unicode):
+			message = message.encode("utf-8")
+		if self.transport == "imperio" and (";" in path + message or "\n" in path + message):
+			raise ValueError("Imperio can't carry ';' or newlines")
+		
+		condition = self.condition
+		condition.acquire()
+		try:
+			if self.closing or len(self.buffer) >= self.MAX_BUFFER:
+				self.dropped += 1
+				if receipt:
+					receipt.done(False)
+				return False
+			if not self.buffer:
+				self.oldest = time()
+			self.buffer.append((path, message, receipt))
+			self.bufferBytes += len(path) + len(message)
+			self.pending += 1
+			if len(self.buffer) == 1 or len(self.buffer) >= self.MAX_BATCH or \
+					self.bufferBytes >= self.MAX_BATCH_BYTES:
+				condition.notify_all()
+			return True
+		finally:
+			condition.release()
+	
+	def send(self, path, message):
+		"""
+		Buffers an update for Dobby, and returns a Receipt for it.
+		"""
+		receipt = Receipt()
+		self.update(path, message, receipt)
+		return receipt
+	
+	def connect(self, uid, paths):
+		return self.update("::connect", json.dumps({uid: list(paths)}))
+	
+	def latest(self, uid, paths):
+		return self.update("::latest", json.dumps({uid: list(paths)}))
+	
+	def disconnect(self, uid, paths):
+		return self.update("::disconnect", json.dumps({uid: list(paths)}))
+	
+	def flush(self, timeout=None):
+		"""
+		Waits until everything buffered so far was delivered (or given up on).
+		Returns False if the timeout passed first.
+		"""
+		deadline = time() + timeout if timeout is not None else None
+		condition = self.condition
+		condition.acquire()
+		try:
+			while self.pending:
+				if deadline is None:
+					condition.wait()
+					continue
+				remaining = deadline - time()
+				if remaining <= 0:
+					return False
+				condition.wait(remaining)
+			return True
+		finally:
+			condition.release()
+	
+	def close(self, timeout=5):
+		"""
+		Delivers what is buffered (for up to timeout seconds), then stops.
+		"""
+		if self.closing:
+			return
+		self.condition.acquire()
+		self.closing = True
+		self.condition.notify_all()
+		self.condition.release()
+		self.thread.join(timeout)
+		for sender in self.senders:
+			try:
+				sender.batches.put(None, timeout=timeout)
+			except Queue.Full:
+				pass
+		for sender in self.senders:
+			sender.join(timeout)
+	
+	#
+	# The flush thread
+	#
+	def run(self):
+		while True:
+			batch = self.takeBatch()
+			if batch is None:
+				break
+			self.dispatch(batch)
+	
+	def takeBatch(self):
+		"""
+		Waits for a batch to be ready, and takes it from the buffer.
+		"""
+		condition = self.condition
+		condition.acquire()
+		try:
+			while not self.buffer:
+				if self.closing:
+					return None
+				condition.wait()
+			while len(self.buffer) < self.MAX_BATCH and self.bufferBytes < self.MAX_BATCH_BYTES and \
+					not self.closing:
+				remaining = self.oldest + self.FLUSH_INTERVAL - time()
+				if remaining <= 0:
+					break
+				condition.wait(remaining)
+			
+			batch = []
+			size = 0
+			buffer = self.buffer
+			while buffer and len(batch) < self.MAX_BATCH and (not batch or size < self.MAX_BATCH_BYTES):
+				item = buffer.popleft()
+				size += len(item[0]) + len(item[1])
+				batch.append(item)
+			self.bufferBytes -= size
+			self.oldest = time()
+			return batch
+		finally:
+			condition.release()
+	
+	def dispatch(self, batch):
+		"""
+		Splits the batch between the connections, by path. Connects, latests and
+		disconnects are split by the paths in them; other commands all go over
+		the first connection.
+		"""
+		senders = self.senders
+		shares = [[] for sender in senders]
+		extra = 0
+		for item in batch:
+			path = item[0]
+			if not path.startswith("::"):
+				shares[self.shard(path)].append(item)
+			elif path in ROUTED:
+				parts = self.split(item)
+				for index, part in parts:
+					shares[index].append(part)
+				extra += len(parts) - 1
+			else:
+				shares[0].append(item)
+		
+		if extra:
+			self.condition.acquire()
+			self.pending += extra
+			self.condition.release()
+		for sender, share in zip(senders, shares):
+			if share:
+				sender.batches.put(share)
+	
+	def shard(self, path):
+		if isinstance(path, unicode):
+			path = path.encode("utf-8")
+		return zlib.crc32(path) % len(self.senders)
+	
+	def split(self, item):
+		"""
+		Returns (connection index, item) for the parts of a connect, latest or
+		disconnect, one for each connection its paths go over.
+		"""
+		command, message, receipt = item
+		shares = {}
+		for uid, paths in parseConnections(message):
+			for path in paths:
+				share = shares.setdefault(self.shard(path), {})
+				share.setdefault(uid, []).append(path)
+		if len(shares) < 2:
+			# Nothing to split (or nothing valid, for Dobby to ignore)
+			return [(shares.keys()[0] if shares else 0, item)]
+		if receipt:
+			receipt.parts = len(shares)
+		return [(index, (command, json.dumps(share), receipt)) for index, share in shares.items()]
+	
+	def delivered(self, batch, delivered):
+		"""
+		Called by a sender once a batch was delivered, or given up on.
+		"""
+		self.condition.acquire()
+		for path, message, receipt in batch:
+			if receipt:
+				receipt.done(delivered)
+		if delivered:
+			self.sent += len(batch)
+		else:
+			self.failed += len(batch)
+		self.pending -= len(batch)
+		if not self.pending:
+			self.condition.notify_all()
+		self.condition.release()
@@ -19,14 +19,19 @@ anyway—much better to send fewer, more important messages.
 Firenzes are synchronous. They will send whatever they have roughly whenever they get it available,
 but only when the client requests it. The client requests with a token they were supplied
 previously: reconnectWith. Right now, this is a (possibly somewhat volatile under some circumstances)
-combination of the Thestral ID and the number of items sent to it last.
+combination of the Thestral ID and the number of items ever queued for it, up to the last one sent.
 
 Because Firenzes are synchronous, this is at least somewhat safe: the server never sends anything
 the client didn't ask for, so it is the client's job to ask for two things: new info, and the removal
-of old info. The number of items sent to the client last is returned to the server to tell it to remove
-that old information (the old X number of items in the queue). Anything newer is sent to the client
+of old info. The number the client was sent last is returned to the server to tell it to remove
+that old information (everything in the queue up to it). Anything newer is sent to the client
 (immediately if any is available, otherwise, after at most MAX_CONNECTION_LENGTH)
 
+If the manager is given a log (Hedwig, from owl.py), Firenzes keep no queue at all: the
+updates stay in Hedwig's per-path logs, and each Firenze keeps only a cursor—the sequence
+number of the last update its client confirmed. reconnectWith then holds the Thestral ID
+and the sequence number of the last update sent.
+
 Each Firenze instance has a timer. It expires after the manager's MAX_CONNECTION_LENGTH
 —30 seconds, by default. At this time, it will send whatever it has (nothing). However,
 if it receives a message, this timer will be replaced with one that expires after the
@@ -36,6 +41,38 @@ that come quickly after each other.
 If messages will never be bundled—or, if you want to send messages immediately, damn
 the consequences—you might as well set this to zero.
 
+Or the manager can batch ADAPTIVEly: each Firenze keeps a moving average of the time
+between the messages it gets. While that is at least DELAY_TRANSMISSION (the client is
+getting messages only now and then), a message is sent right away. In a burst, the
+first message waiting is held for DELAY_TRANSMISSION times however many times busier
+than that the client is, up to MAX_DELAY; the window stretches if the burst picks up,
+and a client that comes back for more in the meantime waits for it to end. Once
+BATCH_BYTES are waiting, though, they are sent at once. Quiet clients thus get their
+messages right away, while busy ones get fewer, larger responses.
+
+Clients may also ask for a stream (?stream=chunked or ?stream=sse). The connection then
+stays open for up to MAX_CONNECTION_LENGTH, and each batch is written as it is ready:
+as a chunk of JSON (the same document as usual, followed by a blank line), or as a
+Server-Sent Event whose data is that document. Nothing is confirmed while the stream is
+open, so every batch's reconnectWith counts everything sent on the stream so far. When the
+stream ends, or the connection drops, the client reconnects with the last reconnectWith it
+received, exactly as it would after a long poll.
+
+Some paths only ever carry the current state of something, so only their latest message
+matters. Those can be marked latest-only, either for every Firenze (the manager's LATEST
+paths or patterns) or for one connection (by connecting it with ::latest rather than
+::connect). A message for such a path then replaces the one still waiting in the queue,
+if there is one, instead of being added after it.
+
+A queue may also be bounded, by number of messages (MAX_QUEUE_LENGTH) and by size in bytes
+(MAX_QUEUE_BYTES). What happens when a message doesn't fit depends on the manager's OVERFLOW
+policy: "drop-oldest" drops the oldest messages not yet sent to make room (on a stream,
+those it already wrote go first), "drop-newest" drops the new message, and "disconnect"
+empties the queue and sends the client a single ::+::overflow message; the session ends when
+the client reconnects after getting it, so the client has to start over. (A message too big
+for even an empty queue is just dropped.) The manager and each Firenze count how often that
+happens (overflows) and how many messages were lost (dropped). With Hedwig, the logs are bounded instead, and these limits do not apply.
+
 The server portion is implemented separately from the main Firenze logic, so it should be
 quite possible to run Firenze on other server technologies than Twisted.
 
@@ -46,12 +83,29 @@ The basic structure of the Twisted implementation is as such:
 * TwistedFirenzeResource, a Twisted.Web Resource
 * TwistedFirenze, an implementation of a Firenze (a Thestral) that is constructed
   with an instance of TwistedFirenzeConnection. Calls timer methods on reactor to set up callbacks, etc.
+
+portkey.py has the same for asyncio: AsyncioFirenzeManager, which makes AsyncioFirenzes,
+and AsyncioFirenzeServer.
+
+Long polls are compressed (gzip or deflate, whichever the client accepts) once a
+response is at least COMPRESS_MIN_SIZE bytes. When one update goes out to many clients,
+their responses differ only in reconnectWith, so the manager compresses everything
+before it once, and keeps the compressor's state; each response then only costs
+compressing its own end, from a copy of that state. Streams are not compressed.
+
+With tens of thousands of connections, scheduling two reactor timers for each of them on
+every poll and message keeps the reactor busy shuffling its timer heap. So the manager can
+have a TimingWheel instead, which TwistedFirenzeServer uses by default: timers go in one of
+the wheel's slots (so scheduling and cancelling them costs O(1)), and every TICK seconds,
+the timers in the current slot all fire in one batch. Timers are thus up to TICK late.
 """
-from wsgiref.handlers import format_date_time
-from datetime import datetime
-from time import mktime
+from time import time
+from collections import OrderedDict
 import urlparse
+import zlib
 from thestral import Thestral
+from owl import SubscriptionIndex
+from imperio import httpDate
 from twisted.internet.protocol import Protocol, Factory
 from twisted.internet import reactor, task
 from twisted.protocols.basic import LineReceiver
@@ -68,10 +122,8 @@ class Firenze(Thestral):
 	getting that queue emptied, so it doesn't matter. If you want greater persistence
 	than what Firenze efficiently allows, you probably want a custom dispatcher.
 	
-	If you do so, please make a nice queued dispatcher named Hedwig in the
-	file owl.py. Thanks :)
-	
-	/notes to self.
+	Hedwig, the queued dispatcher in owl.py, is one: give it to the manager as its
+	log, and the queue stays empty while the Firenze keeps a cursor instead.
 	"""
 	def __init__(self, manager):
 		self.manager = manager
@@ -81,25 +133,87 @@ class Firenze(Thestral):
 		self.isWaitingToSend = False
 		self.iteration = 0
 		self.hasSentAnything = False
+		self.cursor = manager.log.sequence if manager.log else 0
+		self.streaming = None
+		self.streamEnds = 0
+		self.sent = 0
+		
+		# For latest-only paths: where in the queue each one's message is, counting
+		# from the first message ever queued (queueBase is the number no longer in it).
+		self.latest = None
+		self.latestAt = {}
+		self.queueBase = 0
+		self.inFlight = 0
+		
+		self.queueBytes = 0
+		self.overflows = 0
+		self.dropped = 0
+		self.overflowed = False
+		self.overflowNoticed = False
+		self.stopping = False
+		
+		# When the oldest message not yet sent was queued, for metrics
+		self.waitingSince = None
+		
+		# For adaptive batching
+		self.lastArrival = 0
+		self.arrivalInterval = manager.DELAY_TRANSMISSION
+		self.batchStarted = 0
+		self.batchDeadline = 0
+		self.batchBytes = 0
+		
+		self._currentTimeout = None
+		self._currentCancelTimeout = None
 	
 	def update(self, source, path, message):
 		"""
 		Well, you can leave this as-is... or you can do something a bit more clever.
 		For instance, if you are integrating with 
+		
+		An update to ::latest (which Pig sends for ::latest connections) marks
+		the path (or pattern) in the message latest-only for this Firenze, until
+		it is disconnected from it.
 		"""
+		if path == "::latest":
+			self.keepLatest(message)
+			return
+		if path == "::+::disconnect" and self.latest:
+			self.latest.remove(message, self)
 		self.addToQueue(source, path, message)
 	
-	def readyToSend(self):
+	def keepLatest(self, pattern):
+		if not self.latest:
+			self.latest = SubscriptionIndex()
+		self.latest.add(pattern, self)
+	
+	def isLatestOnly(self, path):
+		if self.latest and self.latest.match(path):
+			return True
+		return self.manager.isLatestOnly(path)
+	
+	def readyToSend(self, streaming=None):
 		"""
 		This should be called by subclasses when they are able to send data.
 		It will set isReadyToSend, or will send whatever is already ready to send.
+		
+		streaming is None for a long poll, or "chunked" or "sse" for a stream.
 		"""
 		self.isReadyToSend = True
+		self.streaming = streaming
+		self.sent = 0
+		if streaming:
+			self.streamEnds = time() + self.manager.MAX_CONNECTION_LENGTH
 		self.setCancelTimeout(-1) # Until we send
-		if self.isWaitingToSend or not self.hasSentAnything:
+		if self.isWaitingToSend and self.manager.ADAPTIVE and self.batchDeadline > time():
+			# Still in a burst; let the batch fill up
+			self.pendingTransmission = True
+			self.setTimeout(self.batchDeadline - time())
+		elif self.isWaitingToSend or not self.hasSentAnything:
 			self.isWaitingToSend = False
 			self.processQueue()
 		else:
+			# (This replaces any transmission pending from before we were ready)
+			self.pendingTransmission = False
 			self.setTimeout(self.manager.MAX_CONNECTION_LENGTH)
 	
 	def addToQueue(self, source, path, message):
@@ -110,14 +224,171 @@ class Firenze(Thestral):
 		Separated out so that its caller, update, may be overriden
 		to run from a specific thread.
 		"""
-		self.queue.append({"path": path, "message": message})
+		log = self.manager.log
+		if not log:
+			fragment = self.manager.encode(path, message)
+			self.enqueue(path, fragment)
+			size = len(fragment)
+		else:
+			if source is not log:
+				# Anything that didn't come through the log is logged for us alone
+				log.post(self.id, path, message)
+			if isinstance(message, basestring):
+				size = len(message)
+			else:
+				size = self.manager.SIZE_ESTIMATE
+		if not self.isWaitingToSend and self.manager.dolores.metrics:
+			self.waitingSince = time()
 		self.isWaitingToSend = True
 		
+		if self.manager.ADAPTIVE:
+			self.scheduleAdaptively(size)
+			return
+		
 		# If we are all set, go ahead and try to process
 		if not self.pendingTransmission and self.readyToSend:
 			self.setTimeout(self.manager.DELAY_TRANSMISSION)
 			self.pendingTransmission = True
 	
+	def scheduleAdaptively(self, size):
+		"""
+		Decides when to send, for a manager that batches ADAPTIVEly.
+		"""
+		manager = self.manager
+		now = time()
+		interval = min(now - self.lastArrival, manager.MAX_DELAY)
+		self.lastArrival = now
+		self.arrivalInterval += manager.SMOOTHING * (interval - self.arrivalInterval)
+		self.batchBytes += size
+		
+		if not self.batchDeadline:
+			# The first message since the last send
+			self.batchStarted = now
+		if self.arrivalInterval >= manager.DELAY_TRANSMISSION:
+			# Traffic is sparse: don't wait for more
+			deadline = now
+		elif manager.BATCH_BYTES and self.batchBytes >= manager.BATCH_BYTES:
+			deadline = now
+		else:
+			window = manager.DELAY_TRANSMISSION * manager.DELAY_TRANSMISSION / max(self.arrivalInterval, .001)
+			deadline = self.batchStarted + min(window, manager.MAX_DELAY)
+		
+		if self.pendingTransmission and deadline > now and \
+				abs(deadline - self.batchDeadline) < manager.RESCHEDULE:
+			return
+		self.batchDeadline = deadline
+		self.pendingTransmission = True
+		self.setTimeout(max(deadline - now, 0))
+	
+	def enqueue(self, path, fragment):
+		"""
+		Puts the fragment in the queue (or in place of the one waiting for a
+		latest-only path), keeping to the manager's limits. Returns False if the
+		fragment was dropped.
+		"""
+		if self.overflowed:
+			self.dropped += 1
+			self.manager.dropped += 1
+			return False
+		
+		queue = self.queue
+		latestOnly = self.isLatestOnly(path)
+		if latestOnly:
+			# Replace the message still waiting for this path, if any
+			at = self.latestAt.get(path)
+			if at is not None and at - self.queueBase >= self.inFlight:
+				index = at - self.queueBase
+				self.queueBytes += len(fragment) - len(queue[index])
+				queue[index] = fragment
+				return True
+		
+		if not self.manager.hasRoomFor(len(queue) + 1, self.queueBytes + len(fragment)):
+			if not self.makeRoom(len(fragment)):
+				return False
+		
+		if latestOnly:
+			self.latestAt[path] = self.queueBase + len(queue)
+		queue.append(fragment)
+		self.queueBytes += len(fragment)
+		return True
+	
+	def makeRoom(self, size):
+		"""
+		Called when a message of the given size doesn't fit in the queue; does
+		what the manager's OVERFLOW policy says. Returns whether the message
+		should still be queued.
+		"""
+		manager = self.manager
+		queue = self.queue
+		self.overflows += 1
+		manager.overflows += 1
+		
+		if manager.OVERFLOW == "disconnect":
+			lost = len(queue) - self.inFlight + 1
+			self.queueBase += len(queue)
+			del queue[:]
+			self.queueBytes = 0
+			self.latestAt.clear()
+			self.inFlight = 0
+			self.sent = 0
+			self.overflowed = True
+			
+			# The session ends once the client has had this
+			notice = manager.encode("::+::overflow", "")
+			queue.append(notice)
+			self.queueBytes = len(notice)
+			self.isWaitingToSend = True
+		
+		elif manager.OVERFLOW == "drop-oldest" and not manager.hasRoomFor(1, size):
+			# It wouldn't fit even by itself; drop it alone
+			lost = 1
+		
+		elif manager.OVERFLOW == "drop-oldest":
+			count = len(queue)
+			size += self.queueBytes
+			
+			# On a stream, what was already written goes first: it only waits for
+			# the client to confirm it
+			written = 0
+			while written < self.sent and not manager.hasRoomFor(count - written + 1, size):
+				size -= len(queue[written])
+				written += 1
+			if written:
+				for fragment in queue[:written]:
+					self.queueBytes -= len(fragment)
+				del queue[:written]
+				self.queueBase += written
+				self.sent -= written
+				self.inFlight = max(self.inFlight - written, 0)
+				count -= written
+				if manager.hasRoomFor(count + 1, size):
+					return True
+			
+			# Count the oldest messages not sent yet that have to go
+			drop = self.inFlight
+			while drop < count and not manager.hasRoomFor(count - (drop - self.inFlight) + 1, size):
+				size -= len(queue[drop])
+				drop += 1
+			lost = drop - self.inFlight
+			for fragment in queue[self.inFlight:drop]:
+				self.queueBytes -= len(fragment)
+			del queue[self.inFlight:drop]
+			
+			# Positions moved, so replace nothing that is already queued
+			self.latestAt.clear()
+			if manager.hasRoomFor(count - lost + 1, size):
+				self.dropped += lost
+				manager.dropped += lost
+				return True
+			lost += 1
+		
+		else:
+			lost = 1
+		
+		self.dropped += lost
+		manager.dropped += lost
+		return False
+	
 	def processQueue(self):
 		"""
 		Processes the queue and calls send() with the resulting data.
@@ -127,27 +398,86 @@ class Firenze(Thestral):
 		
 		if not self.isReadyToSend:
 			return
+		self.batchDeadline = 0
+		self.batchBytes = 0
 		
-		# Generate data
-		data = json.dumps({
-			"updates": self.queue,
-			"reconnectWith": self.id + "/" + str(len(self.queue))
-		}) + "\r\n\r\n"
+		# Generate data. The fragments were encoded once by the manager (or the log),
+		# so all we do here is stitch them together. On a stream, skip what was
+		# already sent on it.
+		log = self.manager.log
+		if log:
+			fragments, token = log.collect(self.id, max(self.cursor, self.sent), self.isLatestOnly)
+		elif self.sent:
+			fragments = self.queue[self.sent:]
+			token = len(self.queue)
+		else:
+			fragments = self.queue
+			token = len(fragments)
 		
-		now = datetime.now()
-		stamp = mktime(now.timetuple())
+		if self.streaming == "sse":
+			data = ['data: {"updates": [']
+		else:
+			data = ['{"updates": [']
+		for fragment in fragments:
+			data.append(fragment)
+			data.append(", ")
+		if fragments:
+			data.pop()
+		data.append('], "reconnectWith": ')
+		data.append(json.dumps(self.id + "/" + str(token if log else self.queueBase + token)))
+		if self.streaming == "sse":
+			data.append("}\n\n")
+		else:
+			data.append("}\r\n\r\n")
+		length = 0
+		for piece in data:
+			length += len(piece)
 		
 		headers = "HTTP/1.1 200 OK\r\n"
-		headers += "Date: " + format_date_time(stamp) + "\r\n"
+		headers += "Date: " + httpDate() + "\r\n"
 		headers += "Server: Firenze instance, probably on Dolores.\r\n"
-		headers += "Content-Length: " + str(len(data)) + "\r\n"
+		headers += "Content-Length: " + str(length) + "\r\n"
 		headers += "Content-Type: application/json\r\n\r\n"
 		
 		self.send(headers, data)
-		self.isReadyToSend = False
+		metrics = self.manager.dolores.metrics
+		if metrics:
+			waited = None
+			if self.waitingSince and fragments:
+				waited = time() - self.waitingSince
+			metrics.recordSend(waited, len(fragments), len(self.queue))
+			self.waitingSince = None
 		self.isWaitingToSend = False
 		self.hasSentAnything = True
+		if not log:
+			self.inFlight = token
+		if self.overflowed:
+			self.overflowNoticed = True
 		
+		if self.streaming:
+			self.sent = token
+			remaining = self.streamEnds - time()
+			if remaining > 0:
+				self.setTimeout(remaining)
+				return
+			self.finish()
+		
+		self.isReadyToSend = False
+		self.streaming = None
+		self.setCancelTimeout(self.manager.TIMEOUT_LENGTH)
+	
+	def connectionLost(self):
+		"""
+		Should be called by subclasses if the client goes away while we are
+		ready to send. Whatever was sent since the client last confirmed is
+		kept, so it will be sent again when the client comes back.
+		"""
+		if not self.isReadyToSend:
+			return
+		self.isReadyToSend = False
+		self.streaming = None
+		self.pendingTransmission = False
+		self.setTimeout(-1)
 		self.setCancelTimeout(self.manager.TIMEOUT_LENGTH)
 	
 	def cancel(self):
@@ -155,39 +485,348 @@ class Firenze(Thestral):
 	
 	def confirm(self, count):
 		"""
-		Confirms that the first X items in the queue were sent—removing them
-		from the queue.
+		Confirms that the items in the queue up to X (counting every item ever
+		queued) were sent—removing them from the queue.
 		
 		Safe, because we are completely synchronous. So there.
+		
+		With a log, count is instead the sequence number of the last update
+		received, and the cursor moves up to it.
 		"""
+		log = self.manager.log
+		if log:
+			if count > self.cursor:
+				self.cursor = min(count, log.sequence)
+				log.confirm(self.id, self.cursor)
+			self.isWaitingToSend = log.hasPending(self.id, self.cursor)
+			return
+		
+		queued = len(self.queue)
+		count = max(count - self.queueBase, 0)
+		for fragment in self.queue[0:count]:
+			self.queueBytes -= len(fragment)
 		del self.queue[0:count]
+		self.queueBase += queued - len(self.queue)
+		self.inFlight = 0
+		if not self.queue:
+			self.latestAt.clear()
 		if len(self.queue) > 0:
 			self.isWaitingToSend = True
 		else:
 			self.isWaitingToSend = False
 	
 	def send(self, headers, data):
+		"""
+		data is a sequence of strings (as for writeSequence); fragments in it are
+		shared with other Firenzes, so don't modify them.
+		
+		Unless streaming, this should also end the response.
+		"""
 		pass # Implementors need to implement this.
 	
-	def setTimeout(self, delay):
-		pass # Implementors: Implement this.
+	def finish(self):
+		pass # Implementors: end the response of a stream.
 	
-	def setCancelTimeout(self, delay):
-		pass
+	def callLater(self, duration, callback):
+		"""
+		Calls callback in duration seconds; returns something with a cancel()
+		method. Uses the manager's TimingWheel, if it has one.
+		"""
+		if self.manager.wheel is not None:
+			return self.manager.wheel.schedule(duration, callback)
+		# Implementors: otherwise, schedule it on your event loop.
+	
+	def setTimeout(self, duration):
+		"""
+		Processes the queue in duration seconds. A negative duration just cancels.
+		"""
+		if self._currentTimeout:
+			self._currentTimeout.cancel()
+			self._currentTimeout = None
+		if duration < 0:
+			return
+		if duration == 0:
+			self.processQueue()
+			return
+		self._currentTimeout = self.callLater(duration, self._handleTimeout)
+	
+	def setCancelTimeout(self, duration):
+		"""
+		Ends the session in duration seconds. A negative duration just cancels.
+		"""
+		if self._currentCancelTimeout:
+			self._currentCancelTimeout.cancel()
+			self._currentCancelTimeout = None
+		if duration < 0:
+			# No timer wanted yet
+			return
+		if duration == 0:
+			self.cancel()
+			return
+		self._currentCancelTimeout = self.callLater(duration, self._handleCancelTimeout)
+	
+	def _handleCancelTimeout(self):
+		self._currentCancelTimeout = None
+		self.cancel()
+	
+	def _handleTimeout(self):
+		self._currentTimeout = None
+		self.processQueue()
+
+class WheelTimer(object):
+	"""
+	A timer scheduled on a TimingWheel. Like a reactor's delayed call, it can be
+	cancelled.
+	"""
+	__slots__ = ("slot", "rounds", "callback")
+	
+	def __init__(self, slot, rounds, callback):
+		self.slot = slot
+		self.rounds = rounds
+		self.callback = callback
+	
+	def active(self):
+		return self.slot is not None
+	
+	def cancel(self):
+		if self.slot is not None:
+			self.slot.discard(self)
+			self.slot = None
+
+class TimingWheel(object):
+	"""
+	A hashed timing wheel: SLOTS slots of TICK seconds each. A timer due in n ticks
+	goes in the slot n ticks ahead of the current one, and waits for the wheel to
+	come around (n - 1) / SLOTS more times before it fires.
+	
+	Whatever drives the wheel should call advance() about every TICK seconds.
+	"""
+	def __init__(self, TICK=.05, SLOTS=1024, now=time):
+		self.TICK = TICK
+		self.slots = [set() for i in range(SLOTS)]
+		self.now = now
+		self.ticks = 0
+		self.lastTick = now()
+	
+	def schedule(self, delay, callback):
+		"""
+		Calls callback (with no arguments) after at least delay seconds. Returns
+		a WheelTimer.
+		"""
+		due = self.now() + delay - self.lastTick
+		ticks = int(due / self.TICK)
+		if ticks * self.TICK < due:
+			ticks += 1
+		if ticks < 1:
+			ticks = 1
+		slots = self.slots
+		slot = slots[(self.ticks + ticks) % len(slots)]
+		timer = WheelTimer(slot, (ticks - 1) // len(slots), callback)
+		slot.add(timer)
+		return timer
+	
+	def advance(self):
+		"""
+		Fires everything that is due, one slot per TICK elapsed since last time.
+		"""
+		now = self.now()
+		slots = self.slots
+		while self.lastTick + self.TICK <= now:
+			self.lastTick += self.TICK
+			self.ticks += 1
+			slot = slots[self.ticks % len(slots)]
+			if not slot:
+				continue
+			
+			due = []
+			for timer in slot:
+				if timer.rounds:
+					timer.rounds -= 1
+				else:
+					due.append(timer)
+			for timer in due:
+				slot.discard(timer)
+				timer.slot = None
+			
+			# Callbacks may schedule or cancel timers, so only call them now
+			for timer in due:
+				timer.callback()
+	
+	def __len__(self):
+		count = 0
+		for slot in self.slots:
+			count += len(slot)
+		return count
+
+# Window bits for zlib, by Content-Encoding
+WBITS = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+
+def chooseEncoding(accept):
+	"""
+	Returns "gzip", "deflate" or None, for an Accept-Encoding header.
+	"""
+	if not accept:
+		return None
+	accepted = {}
+	for part in accept.split(","):
+		pieces = part.split(";")
+		coding = pieces[0].strip().lower()
+		quality = 1.0
+		for parameter in pieces[1:]:
+			name, _, value = parameter.partition("=")
+			if name.strip() == "q":
+				try:
+					quality = float(value)
+				except ValueError:
+					quality = 0.0
+		accepted[coding] = quality
+	for coding in ("gzip", "deflate"):
+		if accepted.get(coding, accepted.get("*", 0)) > 0:
+			return coding
+	return None
+
+def encodeUpdate(path, message):
+	"""
+	Returns the JSON fragment Firenze sends for a single update.
+	"""
+	return json.dumps({"path": path, "message": message})
 
 class FirenzeManager(object):
-	def __init__(self, dolores, MAX_CONNECTION_LENGTH=30, DELAY_TRANSMISSION=.25, TIMEOUT_LENGTH=30):
+	# When ADAPTIVE: how much each gap between messages counts toward the average, and
+	# the smallest change in when to send worth moving a timer for
+	SMOOTHING = .5
+	RESCHEDULE = .05
+	
+	# With a log, what a message that isn't a string (Dudley passes on numbers, say)
+	# counts as toward BATCH_BYTES
+	SIZE_ESTIMATE = 64
+	
+	# How many compressed responses to keep the start of
+	COMPRESS_CACHE = 32
+	
+	# How many sessions to end at once (see stop)
+	STOP_BATCH = 5000
+	
+	def __init__(self, dolores, MAX_CONNECTION_LENGTH=30, DELAY_TRANSMISSION=.25, TIMEOUT_LENGTH=30, log=None,
+			TIMER_TICK=None, LATEST=(), MAX_QUEUE_LENGTH=None, MAX_QUEUE_BYTES=None, OVERFLOW="drop-oldest",
+			ADAPTIVE=False, MAX_DELAY=1, BATCH_BYTES=64 * 1024, COMPRESS_MIN_SIZE=1024, COMPRESS_LEVEL=6):
+		"""
+		log, if given, is a Hedwig (see owl.py) that Firenzes read their updates
+		from. Its encode function should be encodeUpdate.
+		
+		If TIMER_TICK is given, Firenzes schedule their timers on a TimingWheel
+		with that tick (the wheel attribute) instead of one by one.
+		
+		LATEST is a list of paths (or patterns) that are latest-only for every
+		Firenze. More can be added with keepLatest.
+		
+		MAX_QUEUE_LENGTH and MAX_QUEUE_BYTES bound each Firenze's queue (None
+		for no bound). OVERFLOW is "drop-oldest", "drop-newest" or "disconnect".
+		
+		If ADAPTIVE, batches are sent right away when messages are few, and held
+		for up to MAX_DELAY seconds (or until BATCH_BYTES are waiting) when they
+		come in bursts; see above.
+		
+		Long polls of at least COMPRESS_MIN_SIZE bytes are compressed at
+		COMPRESS_LEVEL, if the client accepts it (None never compresses).
+		"""
 		self.dolores = dolores
 		self.MAX_CONNECTION_LENGTH = MAX_CONNECTION_LENGTH
 		self.DELAY_TRANSMISSION = DELAY_TRANSMISSION
 		self.TIMEOUT_LENGTH = TIMEOUT_LENGTH
-	def beginNewSession(self, connection):
-		firenze = TwistedFirenze(self)
+		self.log = log
+		self.wheel = TimingWheel(TIMER_TICK) if TIMER_TICK else None
+		self._lastEncoded = (None, None, None)
+		self.latest = SubscriptionIndex()
+		for pattern in LATEST:
+			self.keepLatest(pattern)
+		
+		self.MAX_QUEUE_LENGTH = MAX_QUEUE_LENGTH
+		self.MAX_QUEUE_BYTES = MAX_QUEUE_BYTES
+		self.OVERFLOW = OVERFLOW
+		self.overflows = 0
+		
+		self.ADAPTIVE = ADAPTIVE
+		self.MAX_DELAY = MAX_DELAY
+		self.BATCH_BYTES = BATCH_BYTES
+		
+		self.COMPRESS_MIN_SIZE = COMPRESS_MIN_SIZE
+		self.COMPRESS_LEVEL = COMPRESS_LEVEL
+		self._compressed = OrderedDict()
+		self.dropped = 0
+		self.stopping = []
+	
+	def hasRoomFor(self, length, size):
+		"""
+		Whether a queue of length messages and size bytes is within limits.
+		"""
+		if self.MAX_QUEUE_LENGTH and length > self.MAX_QUEUE_LENGTH:
+			return False
+		if self.MAX_QUEUE_BYTES and size > self.MAX_QUEUE_BYTES:
+			return False
+		return True
+	
+	def keepLatest(self, pattern):
+		self.latest.add(pattern, self)
+	
+	def isLatestOnly(self, path):
+		return bool(self.latest.match(path))
+	
+	def encode(self, path, message):
+		"""
+		Returns the JSON fragment for a single update.
+		
+		Dispatchers hand the very same path and message objects to every Firenze
+		they fan out to, so the last fragment is remembered and reused for as long
+		as the same objects keep coming in. One publish is thus encoded once, not
+		once per subscriber.
+		"""
+		lastPath, lastMessage, fragment = self._lastEncoded
+		if path is lastPath and message is lastMessage:
+			return fragment
+		fragment = encodeUpdate(path, message)
+		self._lastEncoded = (path, message, fragment)
+		return fragment
+	
+	def compress(self, encoding, shared, tail):
+		"""
+		Returns the compressed response made of the shared pieces followed by the
+		tail. The compressor's state after the shared pieces is kept for the next
+		COMPRESS_CACHE different sets of them, as they are most likely those of
+		other clients getting the same updates.
+		"""
+		key = (encoding, tuple(shared))
+		cached = self._compressed.get(key)
+		if not cached:
+			compressor = zlib.compressobj(self.COMPRESS_LEVEL, zlib.DEFLATED, WBITS[encoding])
+			start = compressor.compress("".join(shared)) + compressor.flush(zlib.Z_SYNC_FLUSH)
+			cached = self._compressed[key] = (start, compressor)
+			if len(self._compressed) > self.COMPRESS_CACHE:
+				self._compressed.popitem(last=False)
+		start, compressor = cached
+		compressor = compressor.copy()
+		return start + compressor.compress("".join(tail)) + compressor.flush()
+	
+	def makeFirenze(self):
+		"""
+		Returns a new Firenze for a session. Managers for other servers than
+		Twisted return their own kind.
+		"""
+		return TwistedFirenze(self)
+	
+	def beginNewSession(self, connection, streaming=None, resumeFrom=None, encoding=None):
+		"""
+		resumeFrom, if given, is the last sequence the client got from a session
+		that is gone; the log (if it keeps a journal) takes up from there.
+		"""
+		firenze = self.makeFirenze()
 		firenzeId = self.dolores.registerThestral(firenze)
-		firenze.supplyConnection(connection)
+		if resumeFrom is not None and self.log:
+			firenze.cursor = self.log.resume(firenzeId, resumeFrom)
+		firenze.supplyConnection(connection, streaming, encoding)
 
-	def resumeSession(self, rw, connection):
-		# The reconnectWith holds: uid/confirmCount
+	def resumeSession(self, rw, connection, streaming=None, encoding=None):
+		# The reconnectWith holds: uid/confirmCount (or uid/sequence, with a log)
 		# Split by slash
 		pieces = rw.split("/")
 		
@@ -200,80 +839,159 @@ class FirenzeManager(object):
 			confirm = int(pieces[1])
 		
 		firenze = self.dolores.getThestralById(uid)
+		if firenze and firenze.overflowNoticed:
+			# It was told it overflowed; the session is over
+			self.stop(firenze)
+		if firenze and firenze.stopping:
+			firenze = None
 		if not firenze:
-			self.beginNewSession(connection)
+			# Timed out, or from before a restart: with a log, start over from the
+			# sequence the client has
+			self.beginNewSession(connection, streaming, confirm if self.log else None, encoding)
 			return
 		
-		firenze.confirm(confirm)
-		firenze.supplyConnection(connection)
+		if not firenze.overflowed:
+			# (What the client would confirm was dropped with the overflow; all
+			# that is left is the notice, which it hasn't had yet.)
+			firenze.confirm(confirm)
+		firenze.supplyConnection(connection, streaming, encoding)
 	def stop(self, what):
-		self.dolores.unregisterThestral(what)
+		"""
+		Ends a session. Sessions that end together (as when a load balancer drops
+		thousands of clients, and they all time out in the same tick) are
+		unregistered together, once the current pass of the event loop is over:
+		STOP_BATCH per pass, each batch with a single ::gone.
+		"""
+		if what.stopping:
+			return
+		what.stopping = True
+		self.stopping.append(what)
+		if len(self.stopping) == 1:
+			self.callSoon(self.flushStopping)
+	
+	def flushStopping(self):
+		batch = self.stopping[:self.STOP_BATCH]
+		del self.stopping[:self.STOP_BATCH]
+		if self.stopping:
+			self.callSoon(self.flushStopping)
+		self.dolores.unregisterThestrals(batch)
+	
+	def callSoon(self, callback):
+		"""
+		Calls callback once the current pass of the event loop is over.
+		"""
+		reactor.callLater(0, callback)
+	
+	def watch(self, metrics):
+		"""
+		Adds the manager's overflow and drop counts to a MaraudersMap.
+		"""
+		metrics.watch("firenze_overflows", lambda: self.overflows)
+		metrics.watch("firenze_dropped", lambda: self.dropped)
 		
 class TwistedFirenze(Firenze):
 	def __init__(self, manager):
 		Firenze.__init__(self, manager)
-		self._currentTimeout = None
-		self._currentCancelTimeout = None
 		self.dolores = self.manager.dolores
 	
-	def supplyConnection(self, request):
+	def supplyConnection(self, request, streaming=None, encoding=None):
+		"""
+		encoding is the Content-Encoding to compress the response with, if any.
+		"""
 		self.request = request
-		self.readyToSend()
+		self.encoding = encoding
+		request.notifyFinish().addErrback(self._handleConnectionLost, request)
+		if streaming == "sse":
+			request.setHeader("Content-Type", "text/event-stream")
+			request.setHeader("Cache-Control", "no-cache")
+			request.setHeader("X-Accel-Buffering", "no")
+		elif streaming:
+			request.setHeader("Content-Type", "application/json")
+			request.setHeader("X-Accel-Buffering", "no")
+		self.readyToSend(streaming)
 	
 	def send(self, headers, data):
-		self.request.write(data)
+		if self.encoding and not self.streaming:
+			length = 0
+			for piece in data:
+				length += len(piece)
+			if length >= self.manager.COMPRESS_MIN_SIZE:
+				# Only the last two pieces (the reconnectWith) are this client's own
+				body = self.manager.compress(self.encoding, data[:-2], data[-2:])
+				self.request.setHeader("Content-Encoding", self.encoding)
+				self.request.setHeader("Content-Length", str(len(body)))
+				self.request.write(body)
+				self.request.finish()
+				return
+		
+		# Request has no writeSequence, and one join is cheaper than a write per piece.
+		# Without a Content-Length, each write on a stream goes out as its own chunk.
+		self.request.write("".join(data))
+		if not self.streaming:
+			self.request.finish()
+	
+	def finish(self):
 		self.request.finish()
 	
-	def setTimeout(self, duration): # This should already be running in the right thread, I think.
-		if self._currentTimeout:
-			self._currentTimeout.cancel()
-			self._currentTimeout = None
-		if duration == 0:
-			self.processQueue()
-			return
-		self._currentTimeout = reactor.callLater(duration, self._handleTimeout)
-
-	def setCancelTimeout(self, duration): # This should already be running in the right thread, I think.
-		if self._currentCancelTimeout:
-			self._currentCancelTimeout.cancel()
-			self._currentCancelTimeout = None
-		if duration < 0:
-			# No timer wanted yet
-			return
-		if duration == 0:
-			self.cancel()
-			return
-		self._currentCancelTimeout = reactor.callLater(duration, self._handleCancelTimeout)
-
-	def _handleCancelTimeout(self):
-		self._currentCancelTimeout = None
-		self.cancel()
-
-	def _handleTimeout(self):
-		self._currentTimeout = None
-		self.processQueue()	
+	def _handleConnectionLost(self, reason, request):
+		if request is self.request:
+			self.connectionLost()
 	
+	def callLater(self, duration, callback):
+		if self.manager.wheel is not None:
+			return self.manager.wheel.schedule(duration, callback)
+		return reactor.callLater(duration, callback)
 		
 class TwistedFirenzeResource(resource.Resource):
 	isLeaf = True
-	def __init__(self, dolores, manager):
+	STREAMS = ("chunked", "sse")
+	def __init__(self, dolores, manager, allowStreaming=True):
 		self.dolores = dolores
-		self.manager = manager		
+		self.manager = manager
+		self.allowStreaming = allowStreaming
 	def render_GET(self, request):
 		uid = "/".join(request.postpath)
+		streaming = None
+		if self.allowStreaming:
+			streaming = request.args.get("stream", [None])[0]
+			if not streaming in self.STREAMS:
+				streaming = None
+		encoding = None
+		if not streaming and self.manager.COMPRESS_MIN_SIZE is not None:
+			encoding = chooseEncoding(request.getHeader("accept-encoding"))
+			request.setHeader("Vary", "Accept-Encoding")
 		if uid.strip() == "":
-			self.manager.beginNewSession(request)
+			self.manager.beginNewSession(request, streaming, encoding=encoding)
 		else:
-			self.manager.resumeSession(uid, request)
+			self.manager.resumeSession(uid, request, streaming, encoding)
 		return server.NOT_DONE_YET
 
 class TwistedFirenzeServer(object):
-	def __init__(self, dolores, host="localhost", port=8008):
-		self.manager = FirenzeManager(dolores)
+	def __init__(self, dolores, host="localhost", port=8008, log=None, TIMER_TICK=.05, allowStreaming=True,
+			**options):
+		"""
+		TIMER_TICK is the tick of the manager's TimingWheel; None makes each
+		Firenze use the reactor's timers directly.
+		
+		allowStreaming lets clients ask for a stream rather than a long poll.
+		
+		Any other options (such as MAX_QUEUE_LENGTH) are passed on to the
+		FirenzeManager.
+		"""
+		self.manager = FirenzeManager(dolores, log=log, TIMER_TICK=TIMER_TICK, **options)
 		self.dolores = dolores
 		self.host = host
 		self.port = port
 		
-		self.site = server.Site(TwistedFirenzeResource(self.dolores, self.manager))
-		reactor.listenTCP(self.port, self.site)
+		self.site = server.Site(self.makeResource(allowStreaming))
+		self.listen()
+		if self.manager.wheel is not None:
+			self.wheelLoop = task.LoopingCall(self.manager.wheel.advance)
+			self.wheelLoop.start(TIMER_TICK, now=False)
 		dolores.addStarter(reactor.run)
+	
+	def makeResource(self, allowStreaming):
+		return TwistedFirenzeResource(self.dolores, self.manager, allowStreaming)
+	
+	def listen(self):
+		reactor.listenTCP(self.port, self.site)
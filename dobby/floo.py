@@ -0,0 +1,147 @@
+# coding: utf-8
+"""
+Floo is a binary, framed alternative to Imperio, for backends that send a lot.
+
+Imperio's lines can't hold a newline, lose anything after a ";", and are never
+acknowledged. Floo's frames can hold anything, any number of them may be sent in one
+write, and a sender that wants to know its updates arrived can ask for an ack.
+
+Every frame is:
+	length (4 bytes, big-endian: the length of everything after it)
+	type (1 byte)
+	payload
+
+The types are:
+	U  an update. The payload is the path's length (2 bytes, big-endian), the path,
+	   and then the message, which is everything else.
+	S  a sync. The payload is a sequence number (4 bytes, big-endian), chosen by the
+	   sender. Once every frame before it has been passed on, an A frame with the same
+	   sequence number is sent back. If several syncs arrive in one read, only the
+	   last is answered, as an ack covers everything before it.
+	A  an ack, the answer to a sync.
+
+Floo passes messages on just as they came: there is no escaping to undo, and the only
+copy made is cutting each message out of what was received. A frame that arrives in
+many reads is kept in pieces, and only joined once all of it is there.
+
+The frames themselves are made in floopowder.py, which needs no Twisted.
+
+Like Imperio, Floo is a Thestral: updates sent to it are written to its sender as
+U frames.
+"""
+from twisted.internet.protocol import Protocol, Factory
+from twisted.internet import reactor
+from floopowder import HEADER, PATH_LENGTH, SEQUENCE, UPDATE, SYNC, ACK, encodeUpdate, encodeSync, encodeAck
+
+class Floo(object):
+	"""
+	Translates between Floo frames and Thestral updates, as Imperio does for lines.
+	
+	receiver gets the updates received; sender (anything with write(string)) gets
+	the frames Floo sends. onAck, if given, is called with the sequence number of
+	each ack received.
+	"""
+	MAX_FRAME = 16 * 1024 * 1024
+	MIN_LENGTHS = {UPDATE: 1 + PATH_LENGTH.size, SYNC: 1 + SEQUENCE.size, ACK: 1 + SEQUENCE.size}
+	
+	def __init__(self, receiver=None, sender=None, onAck=None):
+		self.receiver = receiver
+		self.sender = sender
+		self.onAck = onAck
+		
+		# What is left of the last read, in pieces, and how many bytes there have
+		# to be before any of it can be processed
+		self.buffer = []
+		self.buffered = 0
+		self.needed = HEADER.size
+		self.broken = False
+	
+	def update(self, sender, path, message):
+		if self.sender:
+			self.sender.write(encodeUpdate(path, message))
+	
+	def receiveData(self, data):
+		"""
+		Call with received data. Processes every complete frame in it, and keeps
+		the rest for next time. Returns False if the data is not valid Floo, after
+		which nothing more is processed.
+		"""
+		if self.broken:
+			return False
+		if self.buffer:
+			self.buffer.append(data)
+			self.buffered += len(data)
+			if self.buffered < self.needed:
+				# Still not a whole frame
+				return True
+			data = "".join(self.buffer)
+		
+		offset = 0
+		end = len(data)
+		synced = None
+		needed = HEADER.size
+		while end - offset >= HEADER.size:
+			length, kind = HEADER.unpack_from(data, offset)
+			if length < 1 or length > self.MAX_FRAME:
+				self.broken = True
+				return False
+			if end - offset - 4 < length:
+				needed = 4 + length
+				break
+			
+			start = offset + HEADER.size
+			offset += 4 + length
+			kind = chr(kind)
+			if length < self.MIN_LENGTHS.get(kind, 1):
+				self.broken = True
+				return False
+			if kind == UPDATE:
+				pathLength, = PATH_LENGTH.unpack_from(data, start)
+				start += PATH_LENGTH.size
+				if start + pathLength > offset:
+					self.broken = True
+					return False
+				if self.receiver:
+					self.receiver.update(self, data[start:start + pathLength], data[start + pathLength:offset])
+			elif kind == SYNC:
+				synced, = SEQUENCE.unpack_from(data, start)
+			elif kind == ACK:
+				if self.onAck:
+					self.onAck(SEQUENCE.unpack_from(data, start)[0])
+			else:
+				self.broken = True
+				return False
+		
+		if offset < end:
+			rest = data[offset:]
+			self.buffer = [rest]
+			self.buffered = len(rest)
+			self.needed = needed
+		else:
+			self.buffer = []
+			self.buffered = 0
+		if synced is not None and self.sender:
+			self.sender.write(encodeAck(synced))
+		return True
+
+class TwistedFlooConnection(Protocol):
+	def connectionMade(self):
+		self.floo = Floo(self.factory.receiver, self)
+	
+	def dataReceived(self, data):
+		if not self.floo.receiveData(data):
+			self.transport.loseConnection()
+	
+	def write(self, what):
+		self.transport.write(what)
+
+class TwistedFlooServer(Factory):
+	def __init__(self, dolores, receiver=None, host="localhost", port=8005):
+		self.dolores = dolores
+		if not receiver: receiver = dolores
+		self.receiver = receiver
+		self.host = host
+		self.port = port
+		self.protocol = TwistedFlooConnection
+		reactor.listenTCP(self.port, self)
+		dolores.addStarter(reactor.run)
@@ -0,0 +1,28 @@
+# coding: utf-8
+"""
+Floo powder is what Floo frames are made of: their layout, and how to make them (see
+floo.py for what each is for). It needs nothing but the standard library, so
+backends (Errol, for one) can make frames without Twisted.
+"""
+import struct
+
+HEADER = struct.Struct("!IB")
+PATH_LENGTH = struct.Struct("!H")
+SEQUENCE = struct.Struct("!I")
+
+UPDATE = "U"
+SYNC = "S"
+ACK = "A"
+
+def encodeUpdate(path, message):
+	"""
+	Returns the U frame for an update.
+	"""
+	return HEADER.pack(1 + PATH_LENGTH.size + len(path) + len(message), ord(UPDATE)) + \
+		PATH_LENGTH.pack(len(path)) + path + message
+
+def encodeSync(sequence):
+	return HEADER.pack(1 + SEQUENCE.size, ord(SYNC)) + SEQUENCE.pack(sequence)
+
+def encodeAck(sequence):
+	return HEADER.pack(1 + SEQUENCE.size, ord(ACK)) + SEQUENCE.pack(sequence)
@@ -0,0 +1,352 @@
+# coding: utf-8
+"""
+Gringotts keeps every update in a vault on disk, so that clients can pick up
+where they left off after their Firenze timed out, or after a restart.
+
+Each path has its own vault: a directory of append-only segment files, named by
+the first sequence number in them. Segments are preallocated to SEGMENT_SIZE and
+read and written through mmap. Each record is:
+	sequence (8 bytes, big-endian)
+	time (8-byte double)
+	length (4 bytes, big-endian)
+	message
+The message is written before the header, so a record cut short by a crash reads
+as the end of the segment. Each segment keeps the sequence numbers and offsets of
+its records in memory, so reading everything after a sequence is a binary search
+followed by a range read.
+
+Only the MAX_OPEN_FILES segments used most recently are kept mapped (each mapping
+holds a file descriptor); the rest are mapped again when next read or written.
+
+Old segments are dropped once their newest record is older than MAX_AGE seconds,
+or, oldest first, while a vault is larger than MAX_BYTES. This is checked when a
+vault opens a new segment, and whenever prune() is called.
+
+Gringotts is used by Hedwig (see owl.py), which numbers updates with one sequence
+for all paths. As the vaults remember the last sequence, numbering carries on
+after a restart, so reconnectWith tokens stay meaningful. (The sequence, and the
+last sequence each vault dropped, are also written down whenever segments are
+dropped, so they are not forgotten with them.)
+"""
+import mmap
+import os
+import struct
+import urllib
+from bisect import bisect_right
+from collections import OrderedDict
+from time import time
+from owl import SubscriptionIndex
+
+RECORD = struct.Struct("!QdI")
+
+def readNumber(filename):
+	try:
+		f = open(filename)
+		try:
+			return int(f.read().strip() or 0)
+		finally:
+			f.close()
+	except (IOError, ValueError):
+		return 0
+
+def writeNumber(filename, number):
+	temporary = filename + ".new"
+	f = open(temporary, "w")
+	try:
+		f.write("%d\n" % number)
+	finally:
+		f.close()
+	os.rename(temporary, filename)
+
+class GringottsSegment(object):
+	"""
+	One segment file of a vault. It is only mapped while in use; see open().
+	"""
+	def __init__(self, gringotts, filename, first, size):
+		self.gringotts = gringotts
+		self.filename = filename
+		self.first = first
+		self.sequences = []
+		self.offsets = []
+		self.end = 0
+		self.newest = 0
+		self.map = None
+		
+		exists = os.path.exists(filename)
+		if not exists:
+			f = open(filename, "w+b")
+			try:
+				f.truncate(size)
+			finally:
+				f.close()
+		self.size = os.path.getsize(filename)
+		if exists:
+			self.scan()
+	
+	def open(self):
+		"""
+		Returns the segment's mapping, mapping it again if it was closed.
+		"""
+		if self.map is None:
+			f = open(self.filename, "r+b")
+			try:
+				self.map = mmap.mmap(f.fileno(), self.size)
+			finally:
+				# The mapping has its own descriptor
+				f.close()
+		self.gringotts.used(self)
+		return self.map
+	
+	def scan(self):
+		"""
+		Finds the records in a segment written before.
+		"""
+		data = self.open()
+		offset = 0
+		while offset + RECORD.size <= self.size:
+			sequence, stamp, length = RECORD.unpack_from(data, offset)
+			if not sequence or offset + RECORD.size + length > self.size:
+				break
+			self.sequences.append(sequence)
+			self.offsets.append(offset)
+			self.newest = stamp
+			offset += RECORD.size + length
+		self.end = offset
+	
+	def last(self):
+		if self.sequences:
+			return self.sequences[-1]
+		return 0
+	
+	def append(self, sequence, stamp, message):
+		"""
+		Returns False if the record doesn't fit.
+		"""
+		offset = self.end
+		start = offset + RECORD.size
+		if start + len(message) > self.size:
+			return False
+		data = self.open()
+		data[start:start + len(message)] = message
+		RECORD.pack_into(data, offset, sequence, stamp, len(message))
+		self.sequences.append(sequence)
+		self.offsets.append(offset)
+		self.end = start + len(message)
+		self.newest = stamp
+		return True
+	
+	def since(self, sequence, until):
+		"""
+		Returns (sequence, message) for the records after sequence, up to until.
+		"""
+		result = []
+		sequences = self.sequences
+		offsets = self.offsets
+		first = bisect_right(sequences, sequence)
+		if first == len(sequences) or sequences[first] > until:
+			return result
+		data = self.open()
+		for i in xrange(first, len(sequences)):
+			if sequences[i] > until:
+				break
+			offset = offsets[i]
+			length = RECORD.unpack_from(data, offset)[2]
+			start = offset + RECORD.size
+			result.append((sequences[i], data[start:start + length]))
+		return result
+	
+	def close(self):
+		if self.map is not None:
+			self.map.close()
+			self.map = None
+		self.gringotts.closed(self)
+	
+	def remove(self):
+		self.close()
+		os.remove(self.filename)
+
+class GringottsVault(object):
+	"""
+	The journal of a single path. lost is the last sequence dropped from it.
+	"""
+	def __init__(self, gringotts, path, directory):
+		self.gringotts = gringotts
+		self.path = path
+		self.directory = directory
+		self.segments = []
+		self.bytes = 0
+		
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.lost = readNumber(os.path.join(directory, "lost"))
+		names = [name for name in os.listdir(directory) if name.endswith(".seg")]
+		names.sort()
+		for name in names:
+			segment = GringottsSegment(gringotts, os.path.join(directory, name), int(name[:-4]),
+				gringotts.SEGMENT_SIZE)
+			self.segments.append(segment)
+			self.bytes += segment.size
+	
+	def last(self):
+		for segment in reversed(self.segments):
+			if segment.sequences:
+				return segment.last()
+		return self.lost
+	
+	def append(self, sequence, message, stamp):
+		if not self.segments or not self.segments[-1].append(sequence, stamp, message):
+			size = max(self.gringotts.SEGMENT_SIZE, RECORD.size + len(message))
+			segment = GringottsSegment(self.gringotts, os.path.join(self.directory, "%020d.seg" % sequence),
+				sequence, size)
+			self.segments.append(segment)
+			self.bytes += segment.size
+			segment.append(sequence, stamp, message)
+			self.prune(stamp)
+	
+	def read(self, since, until):
+		"""
+		Returns (sequence, message) for the records after since, up to until.
+		"""
+		result = []
+		segments = self.segments
+		for i in range(len(segments)):
+			# Skip segments that end before since
+			if i + 1 < len(segments) and segments[i + 1].first <= since:
+				continue
+			if segments[i].first > until:
+				break
+			result.extend(segments[i].since(since, until))
+		return result
+	
+	def prune(self, now):
+		gringotts = self.gringotts
+		segments = self.segments
+		lost = self.lost
+		while segments:
+			oldest = segments[0]
+			tooOld = gringotts.MAX_AGE and now - oldest.newest > gringotts.MAX_AGE
+			tooBig = gringotts.MAX_BYTES and self.bytes > gringotts.MAX_BYTES and len(segments) > 1
+			if not tooOld and not tooBig:
+				break
+			if lost == self.lost:
+				# Write down what is about to be forgotten
+				gringotts.remember()
+			self.lost = max(self.lost, oldest.last())
+			writeNumber(os.path.join(self.directory, "lost"), self.lost)
+			self.bytes -= oldest.size
+			oldest.remove()
+			segments.pop(0)
+	
+	def close(self):
+		for segment in self.segments:
+			segment.close()
+
+class Gringotts(object):
+	"""
+	The journal of all paths, in directory. SEGMENT_SIZE is the size of each
+	segment file; MAX_AGE (seconds) and MAX_BYTES (per path) bound what is kept.
+	MAX_OPEN_FILES is how many segments may be mapped at once.
+	"""
+	def __init__(self, directory, SEGMENT_SIZE=1024 * 1024, MAX_AGE=24 * 60 * 60, MAX_BYTES=64 * 1024 * 1024,
+			MAX_OPEN_FILES=128):
+		self.directory = directory
+		self.SEGMENT_SIZE = SEGMENT_SIZE
+		self.MAX_AGE = MAX_AGE
+		self.MAX_BYTES = MAX_BYTES
+		self.MAX_OPEN_FILES = max(MAX_OPEN_FILES, 1)
+		self.vaults = {}
+		
+		# The mapped segments, least recently used first
+		self.mapped = OrderedDict()
+		
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.sequence = readNumber(os.path.join(directory, "sequence"))
+		now = time()
+		for name in os.listdir(directory):
+			if os.path.isdir(os.path.join(directory, name)):
+				vault = self.vault(urllib.unquote(name))
+				self.sequence = max(self.sequence, vault.last())
+				vault.prune(now)
+	
+	def wants(self, path):
+		"""
+		Whether updates to the path are kept. Commands (paths starting with
+		"::") are not.
+		"""
+		return not path.startswith("::")
+	
+	def vault(self, path):
+		vault = self.vaults.get(path)
+		if not vault:
+			vault = self.vaults[path] = GringottsVault(self, path,
+				os.path.join(self.directory, urllib.quote(path, safe="")))
+		return vault
+	
+	def vaultsFor(self, pattern):
+		"""
+		Returns the vaults of the paths that match the path or pattern.
+		"""
+		index = SubscriptionIndex()
+		if not index.isPattern(pattern):
+			vault = self.vaults.get(pattern)
+			return [vault] if vault else []
+		index.add(pattern, self)
+		return [vault for path, vault in self.vaults.iteritems() if index.match(path)]
+	
+	def append(self, sequence, path, message):
+		if isinstance(path, unicode):
+			path = path.encode("utf-8")
+		if isinstance(message, unicode):
+			message = message.encode("utf-8")
+		self.vault(path).append(sequence, message, time())
+		self.sequence = sequence
+	
+	def read(self, pattern, since, until):
+		"""
+		Returns (entries, lost). entries are (sequence, path, message) for every
+		update to a path matching the pattern after since, up to until, in order;
+		lost is the last sequence that was dropped from those paths.
+		"""
+		entries = []
+		lost = 0
+		for vault in self.vaultsFor(pattern):
+			for sequence, message in vault.read(since, until):
+				entries.append((sequence, vault.path, message))
+			lost = max(lost, vault.lost)
+		entries.sort()
+		return entries, lost
+	
+	def last(self, pattern):
+		last = 0
+		for vault in self.vaultsFor(pattern):
+			last = max(last, vault.last())
+		return last
+	
+	def remember(self):
+		writeNumber(os.path.join(self.directory, "sequence"), self.sequence)
+	
+	def used(self, segment):
+		"""
+		Called by a mapped segment whenever it is used; unmaps the least recently
+		used segments while too many are mapped.
+		"""
+		mapped = self.mapped
+		if mapped.pop(segment, None) is None:
+			while len(mapped) >= self.MAX_OPEN_FILES:
+				next(iter(mapped)).close()
+		mapped[segment] = True
+	
+	def closed(self, segment):
+		self.mapped.pop(segment, None)
+	
+	def prune(self):
+		now = time()
+		for vault in self.vaults.values():
+			vault.prune(now)
+	
+	def close(self):
+		self.remember()
+		for vault in self.vaults.values():
+			vault.close()
+		self.vaults = {}
@@ -2,9 +2,9 @@ import sys
 from twisted.internet.protocol import Protocol, Factory
 from twisted.internet import reactor, task
 from twisted.protocols.basic import LineReceiver
+from twisted.protocols.policies import TimeoutMixin
 from wsgiref.handlers import format_date_time
-from datetime import datetime
-from time import mktime
+from time import time
 import urllib
 
 """
@@ -119,48 +119,153 @@ class TwistedImperioServer(Factory):
 		reactor.listenTCP(self.port, self)
 		dolores.addStarter(reactor.run)
 
-class TwistedHTTPImperioConnection(LineReceiver):
+_date = [0, ""]
+def httpDate():
+	"""
+	Returns the time, as for a Date header. It only changes once a second, so it is
+	only formatted once a second.
+	"""
+	now = int(time())
+	if now != _date[0]:
+		_date[0] = now
+		_date[1] = format_date_time(now)
+	return _date[1]
+
+class TwistedHTTPImperioConnection(LineReceiver, TimeoutMixin):
+	"""
+	A small HTTP/1.1 server for Imperio commands. A GET sends the command in its
+	URL (GET /path;message); a POST sends any number of them, one per line of its
+	body. Connections are kept alive (unless the client says otherwise, or is
+	HTTP/1.0 and doesn't ask for it), and requests may be pipelined: each is
+	answered, in order, as soon as it has all arrived.
+	"""
+	MAX_BODY = 16 * 1024 * 1024
+	
 	def connectionMade(self):
 		self.imperio = Imperio(self.factory.receiver, self)
-
+		self.request = None
+		self.headers = None
+		self.body = None
+		self.setTimeout(self.factory.IDLE_TIMEOUT)
+	
+	def dataReceived(self, data):
+		self.resetTimeout()
+		LineReceiver.dataReceived(self, data)
+	
+	def timeoutConnection(self):
+		self.transport.loseConnection()
+	
+	def connectionLost(self, reason):
+		# Or the timeout would still go off, for nothing
+		self.setTimeout(None)
+		LineReceiver.connectionLost(self, reason)
+	
 	def lineReceived(self, line):
-		# We pretend to support HTTP GET (even though logically, PUT or POST would be better)
-		# Still, it is all in the URL for simplicity
-		if line.startswith("GET"):
-			self.receivedGET = True
-			l = line.split(" ")
-			if len(l) != 3:
+		if self.request is None:
+			if not line:
+				# Blank lines between requests are allowed
+				return
+			request = line.split(" ")
+			if len(request) != 3:
 				self.transport.loseConnection()
 				return
+			self.request = request
+			self.headers = {}
+			return
+		
+		if line:
+			name, colon, value = line.partition(":")
+			self.headers[name.strip().lower()] = value.strip()
+			return
+		
+		# The end of the headers
+		try:
+			length = int(self.headers.get("content-length") or 0)
+		except ValueError:
+			length = -1
+		if length < 0 or length > self.MAX_BODY:
+			self.transport.loseConnection()
+			return
+		if length:
+			self.body = []
+			self.bodyLength = length
+			self.setRawMode()
+			return
+		self.handleRequest("")
+	
+	def rawDataReceived(self, data):
+		needed = self.bodyLength
+		self.body.append(data[:needed])
+		self.bodyLength -= len(data[:needed])
+		if self.bodyLength > 0:
+			return
+		body = "".join(self.body)
+		self.body = None
+		self.handleRequest(body)
+		if not self.transport.disconnecting:
+			# Anything after the body is the next request
+			self.setLineMode(data[needed:])
+	
+	def handleRequest(self, body):
+		method, target, version = self.request
+		connection = self.headers.get("connection", "").lower()
+		self.request = None
+		self.headers = None
+		if version == "HTTP/1.0":
+			keepAlive = connection == "keep-alive"
+		else:
+			keepAlive = connection != "close"
 		
-			command = urllib.unquote(l[1][1:])
+		if method == "GET":
+			self.imperio.receiveLine(urllib.unquote(target[1:]))
+		elif method == "POST":
+			for line in body.split("\n"):
+				line = line.rstrip("\r")
+				if line:
+					self.imperio.receiveLine(line)
+		else:
+			keepAlive = False
 		
-			# Are we a somebody?
-			self.imperio.receiveLine(command)
-			
-			now = datetime.now()
-			stamp = mktime(now.timetuple())
-			data = "{sent:true}"
-			headers = "HTTP/1.1 200 OK\r\n"
-			headers += "Date: " + format_date_time(stamp) + "\r\n"
-			headers += "Server: Firenze instance, probably on Dolores.\r\n"
-			headers += "Content-Length: " + str(len(data)) + "\r\n"
-			headers += "Content-Type: application/json\r\n\r\n"
-			self.transport.write(headers)
-			self.transport.write(data)
+		self.transport.write(self.factory.response(keepAlive))
+		if not keepAlive:
 			self.transport.loseConnection()
-
+	
 	def write(self, what):
 		self.transport.write(what)
 
 class TwistedHTTPImperioServer(Factory):
-	def __init__(self, dolores, receiver=None, host="localhost", port=8003):
+	RESPONSE = "HTTP/1.1 200 OK\r\n" \
+		"Date: %s\r\n" \
+		"Server: Firenze instance, probably on Dolores.\r\n" \
+		"Content-Length: 11\r\n" \
+		"Content-Type: application/json\r\n" \
+		"Connection: %s\r\n\r\n" \
+		"{sent:true}"
+	
+	def __init__(self, dolores, receiver=None, host="localhost", port=8003, IDLE_TIMEOUT=60):
 		self.dolores = dolores
 		if not receiver: receiver = dolores
 		self.receiver = receiver
 		self.host = host
 		self.port = port
+		self.IDLE_TIMEOUT = IDLE_TIMEOUT
 		self.protocol = TwistedHTTPImperioConnection
+		self.responseDate = None
+		self.responses = {}
 		reactor.listenTCP(self.port, self)
 		dolores.addStarter(reactor.run)
+	
+	def response(self, keepAlive):
+		"""
+		Returns the whole response, which is the same for every request made in
+		the same second.
+		"""
+		date = httpDate()
+		if date != self.responseDate:
+			self.responseDate = date
+			self.responses = {}
+		response = self.responses.get(keepAlive)
+		if not response:
+			response = self.responses[keepAlive] = self.RESPONSE % (date, "keep-alive" if keepAlive else "close")
+		return response
 
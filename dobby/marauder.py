@@ -0,0 +1,215 @@
+# coding: utf-8
+"""
+The Marauder's Map shows where everything is: how long dispatching takes, how many
+listeners each update reaches, how long messages wait in Firenze queues, and which
+paths are busiest.
+
+It is off unless Dolores is given one (as her metrics attribute). Dolores, Pig and the
+Firenzes check for it before measuring anything, so without one, all that is left is a
+check for None.
+
+What is measured:
+* dispatch: microseconds Dolores takes to pass an update to all of her delegates.
+* fanout: how many listeners Pig (or Hedwig) sent each update to.
+* send_delay: microseconds between a message being queued for a Firenze with nothing
+  waiting, and that Firenze sending it.
+* batch_size: how many updates a Firenze sent at once.
+* queue_depth: how many messages a Firenze had queued when it sent.
+* Counts of updates, and of updates and fanout by path since the last snapshot.
+* Anything watched (see watch()), like live connection and subscription counts.
+
+TwistedMarauderServer serves it all as JSON, on localhost only.
+"""
+import heapq
+from time import time
+from twisted.internet import reactor
+from twisted.web import server, resource
+
+try:
+	import simplejson as json
+except:
+	import json
+
+class Histogram(object):
+	"""
+	Counts non-negative integers in buckets whose width grows with the value, as
+	HdrHistogram does: exact below 64, and within about 3% above. Recording is a few
+	integer operations and a dictionary update.
+	"""
+	def __init__(self):
+		self.buckets = {}
+		self.count = 0
+		self.total = 0
+		self.min = None
+		self.max = 0
+	
+	def bucketOf(self, value):
+		if value < 64:
+			return value
+		shift = value.bit_length() - 6
+		return 64 + (shift - 1) * 32 + (value >> shift) - 32
+	
+	def valueOf(self, bucket):
+		"""
+		Returns the lowest value that goes in the bucket.
+		"""
+		if bucket < 64:
+			return bucket
+		shift = (bucket - 64) // 32 + 1
+		return ((bucket - 64) % 32 + 32) << shift
+	
+	def record(self, value):
+		value = int(value)
+		if value < 0:
+			value = 0
+		bucket = self.bucketOf(value)
+		self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+		self.count += 1
+		self.total += value
+		if self.min is None or value < self.min:
+			self.min = value
+		if value > self.max:
+			self.max = value
+	
+	def percentile(self, percent):
+		if not self.count:
+			return 0
+		wanted = self.count * percent / 100.0
+		seen = 0
+		for bucket in sorted(self.buckets):
+			seen += self.buckets[bucket]
+			if seen >= wanted:
+				return min(self.valueOf(bucket), self.max)
+		return self.max
+	
+	def snapshot(self):
+		if not self.count:
+			return {"count": 0}
+		return {
+			"count": self.count,
+			"min": self.min,
+			"max": self.max,
+			"mean": self.total / float(self.count),
+			"p50": self.percentile(50),
+			"p90": self.percentile(90),
+			"p99": self.percentile(99),
+			"p99.9": self.percentile(99.9)
+		}
+
+class MaraudersMap(object):
+	"""
+	Collects the measurements. HOT_PATHS is how many of the busiest paths to show.
+	
+	Paths are only counted between one snapshot and the next, for at most MAX_PATHS
+	of them; updates to any more are counted in paths_dropped.
+	"""
+	def __init__(self, HOT_PATHS=20, MAX_PATHS=10000):
+		self.HOT_PATHS = HOT_PATHS
+		self.MAX_PATHS = MAX_PATHS
+		self.started = time()
+		self.histograms = {}
+		self.counters = {}
+		self.pathUpdates = {}
+		self.pathFanout = {}
+		self.watched = {}
+		self.lastSnapshot = self.started
+	
+	def histogram(self, name):
+		histogram = self.histograms.get(name)
+		if not histogram:
+			histogram = self.histograms[name] = Histogram()
+		return histogram
+	
+	def count(self, name, amount=1):
+		self.counters[name] = self.counters.get(name, 0) + amount
+	
+	def record(self, name, value):
+		self.histogram(name).record(value)
+	
+	def recordTime(self, name, seconds):
+		self.histogram(name).record(seconds * 1000000)
+	
+	def watch(self, name, function):
+		"""
+		Shows function() as name in every snapshot.
+		"""
+		self.watched[name] = function
+	
+	def recordDispatch(self, path, seconds):
+		self.count("updates")
+		self.recordTime("dispatch", seconds)
+	
+	def recordFanout(self, path, listeners):
+		self.record("fanout", listeners)
+		updates = self.pathUpdates.get(path)
+		if updates is None:
+			if self.MAX_PATHS and len(self.pathUpdates) >= self.MAX_PATHS:
+				self.count("paths_dropped")
+				return
+			updates = 0
+		self.pathUpdates[path] = updates + 1
+		self.pathFanout[path] = self.pathFanout.get(path, 0) + listeners
+	
+	def recordSend(self, waited, batchSize, queueDepth):
+		self.count("sends")
+		if waited is not None:
+			self.recordTime("send_delay", waited)
+		self.record("batch_size", batchSize)
+		self.record("queue_depth", queueDepth)
+	
+	def hotPaths(self, now):
+		"""
+		Returns the busiest paths since the last snapshot, with their rates, and
+		starts counting afresh.
+		"""
+		elapsed = max(now - self.lastSnapshot, 1e-6)
+		updates, fanout = self.pathUpdates, self.pathFanout
+		self.pathUpdates = {}
+		self.pathFanout = {}
+		self.lastSnapshot = now
+		
+		hot = []
+		for path in heapq.nlargest(self.HOT_PATHS, updates, key=updates.get):
+			hot.append({
+				"path": path,
+				"updates_per_second": updates[path] / elapsed,
+				"updates": updates[path],
+				"fanout": fanout[path]
+			})
+		return hot
+	
+	def snapshot(self):
+		now = time()
+		histograms = {}
+		for name, histogram in self.histograms.items():
+			histograms[name] = histogram.snapshot()
+		watched = {}
+		for name, function in self.watched.items():
+			watched[name] = function()
+		return {
+			"uptime": now - self.started,
+			"counters": self.counters,
+			"histograms": histograms,
+			"watched": watched,
+			"hot_paths": self.hotPaths(now)
+		}
+
+class TwistedMarauderResource(resource.Resource):
+	isLeaf = True
+	def __init__(self, metrics):
+		self.metrics = metrics
+	
+	def render_GET(self, request):
+		request.setHeader("Content-Type", "application/json")
+		return json.dumps(self.metrics.snapshot())
+
+class TwistedMarauderServer(object):
+	def __init__(self, dolores, metrics, host="localhost", port=8009):
+		self.dolores = dolores
+		self.metrics = metrics
+		self.host = host
+		self.port = port
+		
+		self.site = server.Site(TwistedMarauderResource(self.metrics))
+		reactor.listenTCP(self.port, self.site, interface=self.host)
+		dolores.addStarter(reactor.run)
@@ -1,112 +1,875 @@
 # coding: utf-8
+import traceback
+from collections import deque
+from operator import itemgetter
+from time import time
 from thestral import Thestral
+
+try:
+	import simplejson as json
+except:
+	import json
+
+def parseConnections(message):
+	"""
+	Returns a list of (uid, paths) from the message of a connect or disconnect,
+	with each uid only once. The message is one of:
+	
+	uid->path
+	{"uid": ["path", "path", ...], ...}
+	[["uid", "path"], ["uid", "path"], ...]
+	
+	Anything invalid gives an empty list; uids and paths that aren't strings are
+	skipped.
+	"""
+	if not message[:1] in ("{", "["):
+		parts = message.split("->")
+		if len(parts) != 2:
+			return []
+		return [(parts[0], [parts[1]])]
+	
+	try:
+		data = json.loads(message)
+	except ValueError:
+		return []
+	
+	if isinstance(data, dict):
+		connections = []
+		for uid, paths in data.items():
+			if isinstance(paths, basestring):
+				paths = [paths]
+			elif not isinstance(paths, list):
+				continue
+			paths = [cpath for cpath in paths if isinstance(cpath, basestring)]
+			if paths:
+				connections.append((uid, paths))
+		return connections
+	
+	# Group the pairs by uid, keeping them in order
+	connections = []
+	byUid = {}
+	for pair in data:
+		if not isinstance(pair, list) or len(pair) != 2:
+			continue
+		uid, cpath = pair
+		if not isinstance(uid, basestring) or not isinstance(cpath, basestring):
+			continue
+		if not uid in byUid:
+			byUid[uid] = []
+			connections.append((uid, byUid[uid]))
+		byUid[uid].append(cpath)
+	return connections
+
+class _PathNode(object):
+	"""
+	A node in the SubscriptionIndex trie. children maps a path segment (or "*")
+	to the next node; listeners are those subscribed to the node's pattern, and
+	deepListeners those subscribed to the pattern followed by "/**".
+	"""
+	__slots__ = ("pattern", "children", "listeners", "deepListeners")
+	
+	def __init__(self, pattern=""):
+		self.pattern = pattern
+		self.children = {}
+		self.listeners = set()
+		self.deepListeners = set()
+	
+	def isEmpty(self):
+		return not (self.children or self.listeners or self.deepListeners)
+
+class SubscriptionIndex(object):
+	"""
+	Maps paths and path patterns to the set of listeners subscribed to them.
+	
+	Paths are split into segments on "/". In a pattern, a "*" segment matches
+	exactly one segment, and a trailing "**" matches one or more segments, so
+	"contacts/*" matches "contacts/1" and "contacts/**" matches everything under
+	"contacts/". ("**" anywhere but at the end is just a literal segment.)
+	
+	Plain paths are kept in a dictionary; patterns go in a trie, so matching a
+	path costs O(path depth) (times however many "*" branches actually apply)
+	no matter how many subscriptions there are.
+	"""
+	EMPTY = frozenset()
+	
+	def __init__(self):
+		self.exact = {}
+		self.root = _PathNode()
+	
+	def isPattern(self, path):
+		for segment in path.split("/"):
+			if segment == "*" or segment == "**":
+				return True
+		return False
+	
+	def add(self, pattern, listener):
+		if not self.isPattern(pattern):
+			if not pattern in self.exact:
+				self.exact[pattern] = set()
+			self.exact[pattern].add(listener)
+			return
+		
+		segments = pattern.split("/")
+		deep = segments[-1] == "**"
+		if deep:
+			segments = segments[:-1]
+		
+		node = self.root
+		for segment in segments:
+			child = node.children.get(segment)
+			if not child:
+				if node.pattern:
+					child = _PathNode(node.pattern + "/" + segment)
+				else:
+					child = _PathNode(segment)
+				node.children[segment] = child
+			node = child
+		
+		if deep:
+			node.deepListeners.add(listener)
+		else:
+			node.listeners.add(listener)
+	
+	def remove(self, pattern, listener):
+		"""
+		Removes the listener from the pattern. Returns False if it wasn't there.
+		"""
+		if not self.isPattern(pattern):
+			listeners = self.exact.get(pattern)
+			if not listeners or not listener in listeners:
+				return False
+			listeners.remove(listener)
+			if not listeners:
+				del self.exact[pattern]
+			return True
+		
+		segments = pattern.split("/")
+		deep = segments[-1] == "**"
+		if deep:
+			segments = segments[:-1]
+		
+		# Walk down, remembering the way so empty nodes can be pruned after
+		trail = []
+		node = self.root
+		for segment in segments:
+			child = node.children.get(segment)
+			if not child:
+				return False
+			trail.append((node, segment))
+			node = child
+		
+		listeners = node.deepListeners if deep else node.listeners
+		if not listener in listeners:
+			return False
+		listeners.remove(listener)
+		
+		while trail and node.isEmpty():
+			parent, segment = trail.pop()
+			del parent.children[segment]
+			node = parent
+		return True
+	
+	def subscribers(self, pattern):
+		"""
+		Returns the listeners subscribed to exactly this path or pattern.
+		"""
+		if not self.isPattern(pattern):
+			return self.exact.get(pattern) or self.EMPTY
+		segments = pattern.split("/")
+		deep = segments[-1] == "**"
+		if deep:
+			segments = segments[:-1]
+		node = self.root
+		for segment in segments:
+			node = node.children.get(segment)
+			if not node:
+				return self.EMPTY
+		return node.deepListeners if deep else node.listeners
+	
+	def matchPatterns(self, path):
+		"""
+		Returns a list of (pattern, listeners) pairs for every path or pattern
+		with listeners that the path matches. The sets are the index's own.
+		"""
+		matched = []
+		exact = self.exact.get(path)
+		if exact:
+			matched.append((path, exact))
+		root = self.root
+		if not root.children and not root.deepListeners:
+			return matched
+		
+		nodes = [root]
+		for segment in path.split("/"):
+			following = []
+			for node in nodes:
+				if node.deepListeners:
+					if node.pattern:
+						matched.append((node.pattern + "/**", node.deepListeners))
+					else:
+						matched.append(("**", node.deepListeners))
+				child = node.children.get(segment)
+				if child:
+					following.append(child)
+				if segment != "*":
+					child = node.children.get("*")
+					if child:
+						following.append(child)
+			nodes = following
+			if not nodes:
+				break
+		for node in nodes:
+			if node.listeners:
+				matched.append((node.pattern, node.listeners))
+		return matched
+	
+	def match(self, path):
+		"""
+		Returns the set of listeners subscribed to the path, whether directly or
+		through a pattern. The set may be the index's own, so don't modify it, and
+		don't change subscriptions while iterating over it.
+		"""
+		root = self.root
+		if not root.children and not root.deepListeners:
+			return self.exact.get(path) or self.EMPTY
+		
+		matched = self.matchPatterns(path)
+		if not matched:
+			return self.EMPTY
+		if len(matched) == 1:
+			return matched[0][1]
+		result = set()
+		for pattern, listeners in matched:
+			result.update(listeners)
+		return result
+	
+	def count(self, path):
+		"""
+		Returns how many listeners a message to the path would reach.
+		"""
+		return len(self.match(path))
+	
+	def patterns(self):
+		"""
+		Returns every path and pattern that has listeners.
+		"""
+		result = list(self.exact)
+		nodes = [self.root]
+		while nodes:
+			node = nodes.pop()
+			if node.listeners:
+				result.append(node.pattern)
+			if node.deepListeners:
+				result.append(node.pattern + "/**" if node.pattern else "**")
+			nodes.extend(node.children.itervalues())
+		return result
+
+class Fanout(object):
+	"""
+	Delivers updates to paths with THRESHOLD listeners or more a slice at a time,
+	so that a path with a great many listeners doesn't keep the event loop from
+	everything else while they are all updated.
+	
+	Such an update is queued behind anything still being delivered to the same
+	path, so each path's updates arrive in order. Once per pass of the event loop
+	(callSoon schedules the next), SLICE listeners at a time are updated, taking
+	turns between the busy paths, until BUDGET seconds have passed. The update
+	goes to whoever was listening when it was published.
+	"""
+	def __init__(self, callSoon, THRESHOLD=1000, SLICE=200, BUDGET=.005):
+		self.callSoon = callSoon
+		self.THRESHOLD = THRESHOLD
+		self.SLICE = SLICE
+		self.BUDGET = BUDGET
+		
+		# Path to the updates still being delivered to it, as [sender, message,
+		# listeners, how many were updated]; and the paths that have any, in turn
+		self.queues = {}
+		self.paths = deque()
+		self.scheduled = False
+		
+		self.sliced = 0
+		self.passes = 0
+	
+	def deliver(self, sender, path, message, listeners):
+		queue = self.queues.get(path)
+		if queue is None:
+			if len(listeners) < self.THRESHOLD:
+				for l in listeners:
+					l.update(sender, path, message)
+				return
+			queue = self.queues[path] = deque()
+			self.paths.append(path)
+		queue.append([sender, message, list(listeners), 0])
+		self.sliced += 1
+		if not self.scheduled:
+			self.scheduled = True
+			self.callSoon(self.run)
+	
+	def run(self):
+		deadline = time() + self.BUDGET
+		queues = self.queues
+		paths = self.paths
+		while paths:
+			path = paths.popleft()
+			queue = queues[path]
+			job = queue[0]
+			sender, message, listeners, start = job
+			end = start + self.SLICE
+			for l in listeners[start:end]:
+				l.update(sender, path, message)
+			if end < len(listeners):
+				job[3] = end
+			else:
+				queue.popleft()
+			if queue:
+				paths.append(path)
+			else:
+				del queues[path]
+			if time() >= deadline:
+				break
+		
+		self.passes += 1
+		self.scheduled = False
+		if paths:
+			self.scheduled = True
+			self.callSoon(self.run)
+	
+	def snapshot(self):
+		"""
+		For the Marauder's Map.
+		"""
+		return {"paths": len(self.queues), "sliced": self.sliced, "passes": self.passes}
+
 class Pig(Thestral):
 	"""
 	This is the simplest form of dispatcher. It is a reference implementation.
-	It only responds to three commands: connect, disconnect, and gone.
+	It only responds to four commands: connect, latest, disconnect, and gone.
 	
 	You can easily take a look at the code and see how it works. It is completely
 	trivial. The more advanced dispathcher will be the queued dispatcher.
+	
+	So that backends can skip publishing to paths nobody listens to, Pig also tells
+	Dolores whenever a path (or pattern) gets its first listener, with an update to
+	::interest, and whenever it loses its last, with an update to ::nointerest; the
+	message is the path, or a JSON list of them if a command changed several. (Paths
+	starting with "::" are left out.) These are only sent if anything listens to them.
+	Connecting to ::interest is answered with a JSON list of every path listened to
+	so far. countListeners() answers the same question on demand.
+	
+	cache, if given, is a Remembrall (see remembrall.py) to keep the latest message
+	on each path in. A connect to a path it has a message for is then confirmed with
+	that message, rather than an empty one, so clients needn't ask the backend for
+	the current state. (Connects to patterns are still confirmed with an empty one.)
+	
+	fanout, if given, is a Fanout that delivers updates to paths with many
+	listeners, so that doing so doesn't stall everything else.
 	"""
-	def __init__(self, dolores):
+	COMMANDS = frozenset(("::connect", "::latest", "::disconnect", "::gone"))
+	
+	def __init__(self, dolores, cache=None, fanout=None):
 		"""
-		Listeners is the map of paths to listeners.
+		Listeners is the index of paths (and path patterns) to listeners. The
+		reverse index is protocols, the paths each uid is connected to, and
+		connected, the protocol of each such uid (which is still needed once
+		Dolores has forgotten it, to remove it from listeners when it is gone).
 		"""
 		self.dolores = dolores
-		self.listeners = {}
+		self.listeners = SubscriptionIndex()
 		self.protocols = {}
+		self.connected = {}
+		self.cache = cache
+		self.fanout = fanout
+		
+		# Changes of interest not announced yet: path to whether it is listened to
+		self.interestChanges = {}
+		self.batching = False
+	
+	def countListeners(self, paths):
+		"""
+		Returns a dictionary of each path to the number of listeners an update to
+		it would reach.
+		"""
+		counts = {}
+		for path in paths:
+			counts[path] = self.listeners.count(path)
+		return counts
+	
+	def countSubscriptions(self):
+		count = 0
+		for paths in self.protocols.itervalues():
+			count += len(paths)
+		return count
 	
 	def update(self, sender, path, message):
 		"""
-		Has 3 special paths:
+		Has 4 special paths:
 		::connect uid->path
+		::latest uid->path
 		::disconnect uid->path
 		::gone uid
+		
+		::latest connects just like ::connect, but first tells the protocol (with
+		an update to ::latest) that only the latest message on the path matters.
+		
+		The path in connect and disconnect may be a pattern (see SubscriptionIndex).
+		They also take many at once, as JSON (see parseConnections), as does gone
+		(a JSON list of uids).
+		Returns the number of listeners the update was dispatched to.
 		"""
 		
+		if path in self.COMMANDS:
+			# Announce the changes of interest once the whole command is done
+			self.batching = True
+			try:
+				valid = self.command(path, message)
+			finally:
+				self.batching = False
+			if self.interestChanges:
+				self.announceInterest()
+			if not valid:
+				return
+		elif self.cache is not None and self.cache.wants(path):
+			try:
+				self.cache.remember(path, message)
+			except Exception:
+				# The update matters more than remembering it
+				traceback.print_exc()
+		
+		# We actually allow those special ones to go through, as well...
+		count = self.dispatch(path, message)
+		if self.dolores.metrics:
+			self.dolores.metrics.recordFanout(path, count)
+		return count
+	
+	def command(self, path, message):
+		"""
+		Carries out one of the special paths. Returns False if the message was invalid.
+		"""
 		# First, some stuff applying to connect and disconnect
-		if path == "::connect" or path == "::disconnect":
-			# Get the id and path
-			parts = message.split("->")
-			if len(parts) != 2:
+		if path == "::connect" or path == "::latest" or path == "::disconnect":
+			# Get the ids and paths
+			connections = self.parseConnections(message)
+			if not connections:
 				# invalid.
-				return
-			
-			# Extract separate arguments
-			uid, cpath = parts
+				return False
 			
-			# get the protocol referred to by the id
-			protocol = self.dolores.getThestralById(uid)
+			if path == "::connect":
+				apply = self.connect
+			elif path == "::latest":
+				apply = self.connectLatest
+			else:
+				apply = self.disconnect
 			
-			# Make sure that protocol exists
-			if not protocol:
-				return
-			
-		if path == "::connect":
-			self.connect(uid, protocol, cpath)
-		
-		elif path == "::disconnect":
-			self.disconnect(uid, protocol, cpath)
+			for uid, paths in connections:
+				# get the protocol referred to by the id, and make sure it exists
+				protocol = self.dolores.getThestralById(uid)
+				if not protocol:
+					continue
+				
+				for cpath in paths:
+					apply(uid, protocol, cpath)
 			
 		elif path == "::gone":
-			uid = message
-			
-			# make sure we don't do anything if there is nothing to do
-			if not uid in self.protocols:
-				return
-			
-			# Get protocol
-			protocol = self.dolores.getThestralById(uid)
-			
-			# See if we got a protocol
-			if not protocol:
-				return
-				
-			# Get paths
-			if not uid in self.protocols[uid]:
-				return
-			paths = self.protocols[uid]
-						
-			# remove protocol from listeners
-			# TODO: clean up listener sets when empty.
-			listeners = self.listeners
-			for cpath in paths:
-				listeners[cpath].remove(protocol)
-		
-		# We actually allow those special ones to go through, as well...
-		if path in self.listeners:
-			for l in self.listeners[path]:
-				l.update(self, path, message)
-				
+			if message[:1] == "[":
+				try:
+					uids = json.loads(message)
+				except ValueError:
+					return False
+			else:
+				uids = [message]
+			for uid in uids:
+				self.gone(uid)
+		return True
+	
+	def parseConnections(self, message):
+		return parseConnections(message)
+	
+	def dispatch(self, path, message):
+		"""
+		Sends the update to everything listening to the path. Returns the number
+		of listeners it went to.
+		"""
+		listeners = self.listeners.match(path)
+		self.deliver(path, message, listeners)
+		return len(listeners)
+	
+	def deliver(self, path, message, listeners):
+		if self.fanout is not None:
+			self.fanout.deliver(self, path, message, listeners)
+			return
+		for l in listeners:
+			l.update(self, path, message)
 	
 	def connect(self, uid, protocol, path):
-		# Add a listener set if necessary
-		if not path in self.listeners:
-			self.listeners[path] = set()
-			
-		# Add the protocol to the listener set
-		self.listeners[path].add(protocol)
+		# Add the protocol to the listeners of the path
+		interesting = not self.listeners.subscribers(path)
+		self.listeners.add(path, protocol)
+		if interesting:
+			self.interestChanged(path, True)
 		
 		# and add the listener to the protocol set
-		if not uid in self.protocols: self.protocols[uid] = set()
+		if not uid in self.protocols:
+			self.protocols[uid] = set()
+			self.connected[uid] = protocol
 		self.protocols[uid].add(path)
 		
 		# Send immediate notification to that protocol
-		protocol.update(self, path, "")
+		if path == "::interest":
+			self.notify(uid, protocol, path, json.dumps(self.interestingPaths()))
+			return
+		message = None
+		if self.cache is not None and not self.listeners.isPattern(path):
+			message = self.cache.recall(path)
+		self.notify(uid, protocol, path, message or "")
+	
+	def connectLatest(self, uid, protocol, path):
+		protocol.update(self, "::latest", path)
+		self.connect(uid, protocol, path)
 	
 	def disconnect(self, uid, protocol, path):
-		# See if we need to do anything
-		if not path in self.listeners:
+		# remove (if there is anything to remove)
+		if not self.listeners.remove(path, protocol):
 			return
+		paths = self.protocols[uid]
+		paths.remove(path)
+		if not paths:
+			del self.protocols[uid]
+			del self.connected[uid]
+		if not self.listeners.subscribers(path):
+			self.interestChanged(path, False)
 
-		# and again...
-		if not protocol in self.listeners[path]:
+		# And inform—but on a special disconnect channel because likely
+		# our update is not wanted.
+		self.notify(uid, protocol, "::+::disconnect", path)
+	
+	def gone(self, uid):
+		"""
+		Removes every subscription of a uid that is gone. Returns the paths it
+		was connected to.
+		"""
+		paths = self.protocols.pop(uid, None)
+		if not paths:
+			return ()
+		protocol = self.connected.pop(uid)
+		listeners = self.listeners
+		for cpath in paths:
+			listeners.remove(cpath, protocol)
+			if not listeners.subscribers(cpath):
+				self.interestChanged(cpath, False)
+		return paths
+	
+	def interestingPaths(self):
+		return [path for path in self.listeners.patterns() if not path.startswith("::")]
+	
+	def interestChanged(self, path, interested):
+		"""
+		Called when a path gets its first listener, or loses its last.
+		"""
+		if path.startswith("::"):
 			return
+		changes = self.interestChanges
+		if path in changes:
+			# Changed back within the same command: nothing to tell
+			del changes[path]
+		else:
+			changes[path] = interested
+		if not self.batching:
+			self.announceInterest()
+	
+	def announceInterest(self):
+		changes = self.interestChanges
+		self.interestChanges = {}
+		gained = [path for path, interested in changes.iteritems() if interested]
+		lost = [path for path, interested in changes.iteritems() if not interested]
+		for path, paths in (("::interest", gained), ("::nointerest", lost)):
+			if paths and self.listeners.match(path):
+				self.dolores.update(self, path, paths[0] if len(paths) == 1 else json.dumps(paths))
+	
+	def notify(self, uid, protocol, path, message):
+		"""
+		Sends a message meant for one protocol only (such as the confirmation
+		of a connect).
+		"""
+		protocol.update(self, path, message)
 
-		# remove	
-		self.listeners[path].remove(protocol)
-		self.protocols[uid].remove(path)
 
-		# And inform—but on a special disconnect channel because likely
-		# our update is not wanted.
-		protocol.update(self, "::+::disconnect", path)
+class HedwigLog(object):
+	"""
+	A bounded ring buffer of (sequence, path, item) entries. Once it is full, the
+	oldest entry falls off the end; lost is the sequence of the last one that did.
+	
+	start is the sequence the log started after: nothing before it was logged.
+	"""
+	def __init__(self, size, start=0):
+		self.entries = deque(maxlen=size)
+		self.lost = 0
+		self.start = start
+	
+	def append(self, sequence, path, item):
+		entries = self.entries
+		if len(entries) == entries.maxlen:
+			self.lost = entries[0][0]
+		entries.append((sequence, path, item))
+	
+	def last(self):
+		if self.entries:
+			return self.entries[-1][0]
+		return self.lost
+	
+	def covers(self):
+		"""
+		Everything logged after this sequence is still in the log.
+		"""
+		return max(self.lost, self.start)
+	
+	def since(self, sequence):
+		"""
+		Returns the entries after the sequence, oldest first. Costs as much as
+		there are such entries, not as much as the log holds.
+		"""
+		result = []
+		for entry in reversed(self.entries):
+			if entry[0] <= sequence:
+				break
+			result.append(entry)
+		result.reverse()
+		return result
+
+class Hedwig(Pig):
+	"""
+	The queued dispatcher. Rather than handing every listener its own copy of each
+	update to hold on to, Hedwig keeps one HedwigLog per subscribed path (or
+	pattern), plus a small one per uid for messages meant for it alone (such as
+	connect confirmations). All entries share a single, increasing sequence.
+	
+	Listeners are still updated as with Pig, but only to wake them up: a listener
+	that knows about Hedwig (such as a Firenze whose manager was given one as its
+	log) keeps nothing but a cursor—the last sequence its client confirmed—and
+	calls collect() when it is time to send.
+	
+	Memory therefore grows with the number of messages, not the number of messages
+	times the number of listeners. The price is that a listener which falls more
+	than LOG_SIZE entries behind on a path loses the oldest ones; it is then sent
+	a ::+::missed message with the path, so the client can refetch. (If it falls
+	PRIVATE_LOG_SIZE behind on its own messages, the ::+::missed message is empty.)
+	
+	Items are whatever encode(path, message) returns, or (path, message) tuples
+	if no encode function is given.
+	
+	journal, if given, is a Gringotts (see gringotts.py) that every update is also
+	written to, whether anyone listens or not. What has fallen out of a log is
+	then read back from the journal instead of being missed, and a client whose
+	Firenze is gone (even after a restart) can resume from its last sequence:
+	see resume(). An update the journal fails to take is still sent, and counted
+	in journalErrors.
+	"""
+	def __init__(self, dolores, encode=None, LOG_SIZE=1000, PRIVATE_LOG_SIZE=100, journal=None, cache=None,
+			fanout=None):
+		Pig.__init__(self, dolores, cache, fanout)
+		self.encode = encode
+		self.LOG_SIZE = LOG_SIZE
+		self.PRIVATE_LOG_SIZE = PRIVATE_LOG_SIZE
+		self.journal = journal
+		self.journalErrors = 0
+		self.sequence = journal.sequence if journal else 0
+		self.logs = {}
+		self.private = {}
+		self.joined = {}
+		self.resumed = {}
+	
+	def makeItem(self, path, message):
+		if self.encode:
+			return self.encode(path, message)
+		return (path, message)
+	
+	def dispatch(self, path, message):
+		matched = self.listeners.matchPatterns(path)
+		journal = self.journal
+		if journal and journal.wants(path):
+			self.sequence += 1
+			try:
+				journal.append(self.sequence, path, message)
+			except Exception:
+				# Better sent and not kept than neither
+				self.journalErrors += 1
+				traceback.print_exc()
+		elif matched:
+			self.sequence += 1
+		if not matched:
+			return 0
+		
+		sequence = self.sequence
+		item = self.makeItem(path, message)
+		logs = self.logs
+		for pattern, listeners in matched:
+			log = logs.get(pattern)
+			if not log:
+				log = logs[pattern] = HedwigLog(self.LOG_SIZE, sequence - 1)
+			log.append(sequence, path, item)
+		
+		if len(matched) == 1:
+			listeners = matched[0][1]
+		else:
+			listeners = set()
+			for pattern, l in matched:
+				listeners.update(l)
+		self.deliver(path, message, listeners)
+		return len(listeners)
+	
+	def post(self, uid, path, message):
+		"""
+		Logs a message meant for the uid alone. It does not wake the listener.
+		"""
+		self.sequence += 1
+		log = self.private.get(uid)
+		if not log:
+			log = self.private[uid] = HedwigLog(self.PRIVATE_LOG_SIZE)
+		log.append(self.sequence, path, self.makeItem(path, message))
+	
+	def notify(self, uid, protocol, path, message):
+		self.post(uid, path, message)
+		protocol.update(self, path, message)
+	
+	def connect(self, uid, protocol, path):
+		# Only what is logged from now on is for this uid (or, if it is resuming,
+		# what was logged since it left off)
+		if not uid in self.joined: self.joined[uid] = {}
+		self.joined[uid][path] = self.resumed.get(uid, self.sequence)
+		Pig.connect(self, uid, protocol, path)
+	
+	def resume(self, uid, cursor):
+		"""
+		Called for a new uid that takes over from a client's old one, whose last
+		sequence was cursor. Until the uid confirms anything newer, paths it is
+		connected to are read from cursor on (from the journal, as need be),
+		rather than from when they were connected.
+		
+		Without a journal there is nothing to resume from. Returns the cursor
+		the uid should start from.
+		"""
+		if not self.journal:
+			return self.sequence
+		cursor = max(0, min(cursor, self.sequence))
+		self.resumed[uid] = cursor
+		return cursor
+	
+	def confirm(self, uid, cursor):
+		"""
+		Called when a uid's client confirms it has everything up to cursor.
+		"""
+		if uid in self.resumed and cursor > self.resumed[uid]:
+			del self.resumed[uid]
+	
+	def disconnect(self, uid, protocol, path):
+		Pig.disconnect(self, uid, protocol, path)
+		if uid in self.joined and path in self.joined[uid]:
+			del self.joined[uid][path]
+		self.dropLogIfUnused(path)
+	
+	def dropLogIfUnused(self, pattern):
+		if pattern in self.logs and not self.listeners.subscribers(pattern):
+			del self.logs[pattern]
+	
+	def forget(self, uid):
+		"""
+		Drops the private log of a uid that is gone.
+		"""
+		if uid in self.private:
+			del self.private[uid]
+		if uid in self.joined:
+			del self.joined[uid]
+		if uid in self.resumed:
+			del self.resumed[uid]
+	
+	def gone(self, uid):
+		paths = Pig.gone(self, uid)
+		self.forget(uid)
+		for pattern in paths:
+			self.dropLogIfUnused(pattern)
+		return paths
+	
+	def logsFor(self, uid, cursor):
+		"""
+		Returns (pattern, log, since) for each log the uid reads from; since is
+		the cursor, or when the uid connected to the pattern if that was later.
+		
+		With a journal, patterns nothing was logged for yet are included too,
+		with None as their log.
+		"""
+		logs = []
+		joined = self.joined.get(uid, {})
+		journal = self.journal
+		for pattern in self.protocols.get(uid, ()):
+			log = self.logs.get(pattern)
+			if log or journal:
+				logs.append((pattern, log, max(cursor, joined.get(pattern, 0))))
+		log = self.private.get(uid)
+		if log:
+			logs.append((None, log, cursor))
+		return logs
+	
+	def hasPending(self, uid, cursor):
+		"""
+		Whether anything for the uid was logged after the cursor.
+		"""
+		journal = self.journal
+		for pattern, log, since in self.logsFor(uid, cursor):
+			if log and log.last() > since:
+				return True
+			if pattern and journal:
+				covered = log.covers() if log else self.sequence
+				if since < covered and journal.last(pattern) > since:
+					return True
+		return False
+	
+	def collect(self, uid, cursor, isLatestOnly=None):
+		"""
+		Returns (items, sequence): the items for the uid logged after the cursor,
+		in order, and the sequence of the last of them (or the cursor, if there
+		are none).
+		
+		If isLatestOnly(path) is true, only the last item for that path is kept.
+		"""
+		entries = []
+		missed = []
+		journal = self.journal
+		for pattern, log, since in self.logsFor(uid, cursor):
+			if pattern and journal:
+				# Read whatever is no longer (or not yet) in the log from the journal
+				covered = log.covers() if log else self.sequence
+				if since < covered:
+					journaled, lost = journal.read(pattern, since, covered)
+					if lost > since:
+						missed.append(pattern)
+					for sequence, path, message in journaled:
+						entries.append((sequence, path, self.makeItem(path, message)))
+					since = covered
+			elif log.lost > since:
+				# (For the uid's own log, pattern is None)
+				missed.append(pattern or "")
+			if log:
+				entries.extend(log.since(since))
+		
+		if not entries:
+			return [], cursor
+		
+		# The same update may be in several logs if more than one of the uid's
+		# patterns matched it; they have the same sequence, so skip repeats.
+		entries.sort(key=itemgetter(0))
+		items = []
+		for pattern in missed:
+			items.append(self.makeItem("::+::missed", pattern))
+		last = cursor
+		latest = {}
+		for sequence, path, item in entries:
+			if sequence == last:
+				continue
+			last = sequence
+			if isLatestOnly and isLatestOnly(path):
+				if path in latest:
+					items[latest[path]] = item
+					continue
+				latest[path] = len(items)
+			items.append(item)
+		return items, last
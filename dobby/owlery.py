@@ -0,0 +1,317 @@
+# coding: utf-8
+"""
+The Owlery runs Dobby on more than one core. It is a process of its own that takes
+every publish (through Imperio, Dudley and Floo, as usual), and sends them on to
+a number of worker processes over a UNIX socket, as Floo frames (see floo.py).
+Each worker has its own Dolores, dispatcher and Firenze server, and the Firenze
+servers all listen on the same port (with SO_REUSEPORT), so the kernel shares the
+clients out between them.
+
+A worker's Dolores gives out ids starting with the worker's own (see workerId), so
+the Owlery knows which worker each uid lives on:
+* Updates to paths go to every worker, since any may have listeners for them.
+* ::connect, ::latest and ::disconnect go only to the workers with the uids in
+  them, each worker getting just its own uids.
+Each worker gets its updates in the order the Owlery did.
+
+A client's next poll may reach a different worker than the one its session lives
+on. That worker then passes the request on, over a UNIX socket the session's worker
+listens on as well, and passes back the response (see
+TwistedOwleryFirenzeResource).
+
+What a worker does by itself (::gone when sessions end, ::interest, the Marauder's
+Map) only covers its own sessions.
+
+dobby.py runs the Owlery when WORKERS is more than 1; it starts the workers by
+running dobby.py again, with DOBBY_WORKER set to each one's number.
+"""
+import os
+import socket
+import sys
+from twisted.internet import reactor
+from twisted.internet.protocol import Protocol, Factory, ClientFactory, ProcessProtocol
+from twisted.internet.address import UNIXAddress
+from twisted.internet.error import ReactorNotRunning
+from twisted.web import server, proxy
+from thestral import Thestral
+from owl import parseConnections
+from floo import Floo, encodeUpdate
+from firenze import TwistedFirenzeServer, TwistedFirenzeResource
+
+try:
+	import simplejson as json
+except:
+	import json
+
+# Not in Python 2's socket module; this is Linux's
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+ROUTED = frozenset(("::connect", "::latest", "::disconnect"))
+
+def workerId(worker):
+	"""
+	The id for a worker's Dolores, which starts every id she gives out.
+	"""
+	return "DOLORES%d" % worker
+
+def workerOf(uid):
+	"""
+	Returns the number of the worker a uid lives on, or None if it is not a
+	worker's.
+	"""
+	prefix = uid.split("-", 1)[0]
+	if prefix.startswith("DOLORES") and prefix[7:].isdigit():
+		return int(prefix[7:])
+	return None
+
+def busSocket(directory):
+	return os.path.join(directory, "owlery.sock")
+
+def firenzeSocket(directory, worker):
+	return os.path.join(directory, "firenze-%d.sock" % worker)
+
+def stopReactor():
+	try:
+		reactor.stop()
+	except ReactorNotRunning:
+		pass
+
+def listenUNIX(filename, factory):
+	if os.path.exists(filename):
+		os.remove(filename)
+	return reactor.listenUNIX(filename, factory)
+
+def listenReusePort(port, factory, interface=""):
+	"""
+	Listens on a TCP port that other processes may listen on as well.
+	"""
+	s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+	s.bind((interface, port))
+	s.listen(1024)
+	s.setblocking(False)
+	try:
+		return reactor.adoptStreamPort(s.fileno(), socket.AF_INET, factory)
+	finally:
+		# The reactor has its own copy
+		s.close()
+
+class Owlery(Thestral):
+	"""
+	Sends what Dolores gets on to the workers. Delegate it to the Owlery's Dolores.
+	"""
+	def __init__(self):
+		self.id = "OWLERY"
+		self.workers = {}
+	
+	def update(self, sender, path, message):
+		if isinstance(path, unicode):
+			path = path.encode("utf-8")
+		if isinstance(message, unicode):
+			message = message.encode("utf-8")
+		if path in ROUTED:
+			self.route(path, message)
+			return
+		frame = encodeUpdate(path, message)
+		for worker in self.workers.itervalues():
+			worker.write(frame)
+	
+	def route(self, path, message):
+		"""
+		Sends each worker the part of a connect or disconnect for its own uids.
+		"""
+		shares = {}
+		for uid, paths in parseConnections(message):
+			worker = workerOf(uid)
+			if worker in self.workers:
+				if not worker in shares:
+					shares[worker] = {}
+				shares[worker][uid] = paths
+		for worker, share in shares.iteritems():
+			self.workers[worker].write(encodeUpdate(path, json.dumps(share)))
+	
+	def joined(self, worker, connection):
+		self.workers[worker] = connection
+	
+	def left(self, worker, connection):
+		if self.workers.get(worker) is connection:
+			del self.workers[worker]
+
+class TwistedOwleryConnection(Protocol):
+	"""
+	The Owlery's end of a worker's connection. The worker's first frame is an
+	update to ::worker, with its number.
+	"""
+	worker = None
+	
+	def connectionMade(self):
+		self.floo = Floo(self)
+	
+	def dataReceived(self, data):
+		if not self.floo.receiveData(data):
+			self.transport.loseConnection()
+	
+	def update(self, sender, path, message):
+		if path == "::worker" and self.worker is None and message.isdigit():
+			self.worker = int(message)
+			self.factory.owlery.joined(self.worker, self)
+	
+	def connectionLost(self, reason):
+		if self.worker is not None:
+			self.factory.owlery.left(self.worker, self)
+	
+	def write(self, what):
+		self.transport.write(what)
+
+class TwistedOwleryWorker(ProcessProtocol):
+	"""
+	Watches a worker process, and starts it again if it exits.
+	"""
+	def __init__(self, server, worker):
+		self.server = server
+		self.worker = worker
+	
+	def processEnded(self, reason):
+		self.server.ended(self)
+
+class TwistedOwleryServer(Factory):
+	"""
+	Listens for the workers on a UNIX socket in directory, and starts WORKERS of
+	them, each running script (dobby.py) with DOBBY_WORKER set to its number.
+	"""
+	RESTART_DELAY = 1
+	
+	def __init__(self, dolores, directory, WORKERS, script=None):
+		self.dolores = dolores
+		self.directory = directory
+		self.WORKERS = WORKERS
+		self.script = script or os.path.abspath(sys.argv[0])
+		self.owlery = Owlery()
+		self.protocol = TwistedOwleryConnection
+		self.processes = {}
+		self.stopping = False
+		
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		listenUNIX(busSocket(directory), self)
+		dolores.delegate(self.owlery)
+		for worker in range(WORKERS):
+			self.start(worker)
+		reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+		dolores.addStarter(reactor.run)
+	
+	def start(self, worker):
+		env = dict(os.environ)
+		env["DOBBY_WORKER"] = str(worker)
+		process = TwistedOwleryWorker(self, worker)
+		self.processes[worker] = reactor.spawnProcess(process, sys.executable, [sys.executable, self.script],
+			env=env, path=os.path.dirname(self.script) or None, childFDs={0: 0, 1: 1, 2: 2})
+	
+	def ended(self, process):
+		del self.processes[process.worker]
+		if not self.stopping:
+			reactor.callLater(self.RESTART_DELAY, self.start, process.worker)
+	
+	def stop(self):
+		self.stopping = True
+		for transport in self.processes.values():
+			try:
+				transport.signalProcess("TERM")
+			except Exception:
+				pass
+
+class TwistedOwleryClient(Protocol):
+	"""
+	A worker's end of its connection to the Owlery: passes what comes to Dolores.
+	"""
+	def connectionMade(self):
+		self.floo = Floo(self.factory.dolores)
+		self.transport.write(encodeUpdate("::worker", str(self.factory.worker)))
+	
+	def dataReceived(self, data):
+		if not self.floo.receiveData(data):
+			self.transport.loseConnection()
+	
+	def connectionLost(self, reason):
+		# Without the Owlery there is nothing to do. (This waits a little, as
+		# the Owlery going away usually means the worker is told to stop, too.)
+		reactor.callLater(self.factory.STOP_DELAY, stopReactor)
+
+class TwistedOwleryClientFactory(ClientFactory):
+	protocol = TwistedOwleryClient
+	STOP_DELAY = 1
+	
+	def __init__(self, dolores, worker, directory):
+		self.dolores = dolores
+		self.worker = worker
+		reactor.connectUNIX(busSocket(directory), self)
+		dolores.addStarter(reactor.run)
+	
+	def clientConnectionFailed(self, connector, reason):
+		print "Worker %d could not reach the Owlery: %s" % (self.worker, reason.getErrorMessage())
+		stopReactor()
+
+class TwistedOwleryProxyClient(proxy.ProxyClient):
+	"""
+	Passes back the response of the worker a request was passed on to.
+	"""
+	def connectionMade(self):
+		proxy.ProxyClient.connectionMade(self)
+		# If the client goes away, so does the request to the other worker
+		self.father.notifyFinish().addErrback(self.fatherLost)
+	
+	def fatherLost(self, reason):
+		self._finished = True
+		self.transport.loseConnection()
+	
+	def handleHeader(self, key, value):
+		# This connection is the client's, whatever the worker's was like
+		if key.lower() in ("connection", "keep-alive"):
+			return
+		proxy.ProxyClient.handleHeader(self, key, value)
+
+class TwistedOwleryProxyClientFactory(proxy.ProxyClientFactory):
+	protocol = TwistedOwleryProxyClient
+
+class TwistedOwleryFirenzeResource(TwistedFirenzeResource):
+	"""
+	Passes polls for sessions on other workers on to them.
+	"""
+	def __init__(self, dolores, manager, allowStreaming, worker, directory):
+		TwistedFirenzeResource.__init__(self, dolores, manager, allowStreaming)
+		self.worker = worker
+		self.directory = directory
+	
+	def render_GET(self, request):
+		uid = request.postpath[0] if request.postpath else ""
+		owner = workerOf(uid)
+		if owner is None or owner == self.worker or isinstance(request.getHost(), UNIXAddress):
+			# Passed on to us already, or ours (or no one's) to begin with
+			return TwistedFirenzeResource.render_GET(self, request)
+		
+		filename = firenzeSocket(self.directory, owner)
+		if not os.path.exists(filename):
+			return TwistedFirenzeResource.render_GET(self, request)
+		factory = TwistedOwleryProxyClientFactory(request.method, request.uri, request.clientproto,
+			request.getAllHeaders(), "", request)
+		reactor.connectUNIX(filename, factory)
+		return server.NOT_DONE_YET
+
+class TwistedOwleryFirenzeServer(TwistedFirenzeServer):
+	"""
+	A worker's Firenze server: listens on the port shared with the other workers,
+	and on a UNIX socket of its own, for polls passed on by them.
+	"""
+	def __init__(self, dolores, worker, directory, **options):
+		self.worker = worker
+		self.directory = directory
+		TwistedFirenzeServer.__init__(self, dolores, **options)
+	
+	def makeResource(self, allowStreaming):
+		return TwistedOwleryFirenzeResource(self.dolores, self.manager, allowStreaming, self.worker,
+			self.directory)
+	
+	def listen(self):
+		listenReusePort(self.port, self.site)
+		listenUNIX(firenzeSocket(self.directory, self.worker), self.site)
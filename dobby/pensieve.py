@@ -0,0 +1,311 @@
+# coding: utf-8
+"""
+The Pensieve is for looking back at where the time went.
+
+It does two things, both started while the server runs, by updates to Dolores (so
+from Imperio, for instance):
+
+::trace;FRACTION
+	Traces that fraction of updates (0 stops tracing). A traced update is timed at
+	every update() it passes through on its way out: Dolores, then each of her
+	delegates, then each Firenze (or Imperio, or anything else) the dispatcher
+	sends it to. The timings are kept by hop, and as a flame graph of the traced
+	updates (see ::trace-dump).
+
+::trace-dump;FILE
+	Writes the traced hops to FILE as folded stacks ("Dolores.update;Pig.update
+	123", where 123 is microseconds spent in Pig.update itself), the format of
+	flamegraph.pl and speedscope.
+
+::profile;SECONDS [sample|cprofile] [FILE]
+	Profiles the whole server for that many seconds. "sample" (the default)
+	samples the Python stack every INTERVAL seconds of CPU time, and writes the
+	samples as folded stacks. "cprofile" runs cProfile, and writes its stats
+	(for pstats, snakeviz, or flameprof). FILE defaults to a name with the time
+	in it.
+
+FILE is only ever a name for a file in directory: one with a path in it (or "..")
+is ignored, along with the command.
+
+Tracing works by wrapping the update method of the classes in CLASSES, only while
+tracing is on; otherwise they are left as they are, and cost nothing.
+
+WARNING: anything that can send updates to Dolores can start a profile that
+writes a file (though only in directory). See the warning about Imperio's port in
+dobby.py.
+"""
+import cProfile
+import os
+import random
+import signal
+from collections import deque
+from time import time, strftime
+from twisted.internet import reactor
+from thestral import Thestral
+from marauder import Histogram
+
+def writeFolded(stacks, filename):
+	"""
+	Writes a dictionary of stack (frames separated by ";") to count, as folded
+	stacks.
+	"""
+	f = open(filename, "w")
+	try:
+		for stack, count in sorted(stacks.items()):
+			f.write("%s %d\n" % (stack, count))
+	finally:
+		f.close()
+
+class Trace(object):
+	"""
+	The hops of a single traced update.
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.started = time()
+		self.stack = []
+		self.childTime = []
+		self.hops = []
+
+class Sampler(object):
+	"""
+	A statistical profiler: every INTERVAL seconds of CPU time, SIGPROF interrupts
+	whatever is running and its stack is counted. It must be started and stopped
+	from the main thread (as the reactor's is).
+	"""
+	def __init__(self, INTERVAL=.005):
+		self.INTERVAL = INTERVAL
+		self.stacks = {}
+		self.samples = 0
+		self.previous = None
+	
+	def start(self):
+		self.previous = signal.signal(signal.SIGPROF, self.sample)
+		signal.setitimer(signal.ITIMER_PROF, self.INTERVAL, self.INTERVAL)
+	
+	def stop(self):
+		signal.setitimer(signal.ITIMER_PROF, 0, 0)
+		signal.signal(signal.SIGPROF, self.previous or signal.SIG_DFL)
+	
+	def sample(self, signum, frame):
+		frames = []
+		while frame is not None:
+			code = frame.f_code
+			frames.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+			frame = frame.f_back
+		frames.reverse()
+		stack = ";".join(frames)
+		self.stacks[stack] = self.stacks.get(stack, 0) + 1
+		self.samples += 1
+	
+	def write(self, filename):
+		writeFolded(self.stacks, filename)
+
+class Pensieve(Thestral):
+	"""
+	Traces and profiles; see above. CLASSES is the list of classes whose update
+	methods are timed when tracing (by default, those dobby.py uses). KEEP is how
+	many traces to keep in traces.
+	"""
+	def __init__(self, dolores, CLASSES=None, KEEP=100, INTERVAL=.005, directory="."):
+		self.id = "PENSIEVE"
+		self.dolores = dolores
+		if CLASSES is None:
+			CLASSES = self.defaultClasses()
+		self.CLASSES = CLASSES
+		self.INTERVAL = INTERVAL
+		self.directory = directory
+		
+		self.SAMPLE = 0
+		self.trace = None
+		self.traces = deque(maxlen=KEEP)
+		self.traced = 0
+		self.hops = {}
+		self.folded = {}
+		self.originals = []
+		self.profiling = None
+	
+	def defaultClasses(self):
+		from dolores import Dolores
+		from owl import Pig, Hedwig
+		from firenze import Firenze
+		from imperio import Imperio
+		from floo import Floo
+		from skeeter import Skeeter
+		return [Dolores, Pig, Hedwig, Firenze, Imperio, Floo, Skeeter]
+	
+	def update(self, sender, path, message):
+		if path == "::trace":
+			try:
+				self.setSample(float(message))
+			except ValueError:
+				pass
+		elif path == "::trace-dump":
+			filename = self.safeFilename(message.strip())
+			if filename is not None:
+				self.dump(filename or self.makeFilename("trace", "folded"))
+		elif path == "::profile":
+			pieces = message.split()
+			try:
+				seconds = float(pieces[0])
+			except (ValueError, IndexError):
+				return
+			mode = pieces[1] if len(pieces) > 1 else "sample"
+			filename = self.safeFilename(pieces[2] if len(pieces) > 2 else "")
+			if filename is not None:
+				self.profile(seconds, mode, filename or None)
+	
+	def makeFilename(self, what, extension):
+		return os.path.join(self.directory, "dobby-%s-%s.%s" % (what, strftime("%Y%m%d-%H%M%S"), extension))
+	
+	def safeFilename(self, name):
+		"""
+		Returns where in directory a file name sent in a command goes, "" if none
+		was sent, or None if it is not just a file name.
+		"""
+		if not name:
+			return ""
+		if "/" in name or os.sep in name or (os.altsep and os.altsep in name) or \
+				name in (".", "..") or "\0" in name:
+			return None
+		return os.path.join(self.directory, name)
+	
+	#
+	# Tracing
+	#
+	def setSample(self, fraction):
+		"""
+		Traces that fraction of updates from now on.
+		"""
+		self.SAMPLE = max(0, min(fraction, 1))
+		if self.SAMPLE and not self.originals:
+			self.install()
+		elif not self.SAMPLE and self.originals:
+			self.uninstall()
+	
+	def install(self):
+		for cls in self.CLASSES:
+			original = cls.__dict__.get("update")
+			if original:
+				self.originals.append((cls, original))
+				cls.update = self.wrap(cls.__name__ + ".update", original)
+	
+	def uninstall(self):
+		for cls, original in self.originals:
+			cls.update = original
+		self.originals = []
+	
+	def wrap(self, name, original):
+		pensieve = self
+		def update(thestral, sender, path, message):
+			trace = pensieve.trace
+			if trace:
+				return pensieve.hop(trace, name, original, thestral, sender, path, message)
+			if trace is None:
+				return pensieve.begin(name, original, thestral, sender, path, message)
+			# Inside an update that is not being traced
+			return original(thestral, sender, path, message)
+		update.__doc__ = original.__doc__
+		return update
+	
+	def begin(self, name, original, thestral, sender, path, message):
+		"""
+		Called for updates that are not inside another: decides whether to trace it.
+		"""
+		if random.random() >= self.SAMPLE:
+			self.trace = False
+			try:
+				return original(thestral, sender, path, message)
+			finally:
+				self.trace = None
+		
+		trace = self.trace = Trace(path)
+		try:
+			return self.hop(trace, name, original, thestral, sender, path, message)
+		finally:
+			self.trace = None
+			self.finish(trace)
+	
+	def hop(self, trace, name, original, thestral, sender, path, message):
+		trace.stack.append(name)
+		trace.childTime.append(0)
+		start = time()
+		try:
+			return original(thestral, sender, path, message)
+		finally:
+			elapsed = time() - start
+			own = elapsed - trace.childTime.pop()
+			if trace.childTime:
+				trace.childTime[-1] += elapsed
+			trace.hops.append((";".join(trace.stack), elapsed, own))
+			trace.stack.pop()
+	
+	def finish(self, trace):
+		self.traced += 1
+		self.traces.append(trace)
+		hops = self.hops
+		folded = self.folded
+		for stack, elapsed, own in trace.hops:
+			name = stack.rsplit(";", 1)[-1]
+			histogram = hops.get(name)
+			if not histogram:
+				histogram = hops[name] = Histogram()
+			histogram.record(elapsed * 1000000)
+			folded[stack] = folded.get(stack, 0) + int(own * 1000000)
+	
+	def dump(self, filename):
+		writeFolded(self.folded, filename)
+	
+	def snapshot(self):
+		"""
+		The tracing state, as a dictionary (for a MaraudersMap to watch).
+		"""
+		hops = {}
+		for name, histogram in self.hops.items():
+			hops[name] = histogram.snapshot()
+		return {
+			"sample": self.SAMPLE,
+			"traced": self.traced,
+			"hops_us": hops,
+			"profiling": self.profiling
+		}
+	
+	#
+	# Profiling
+	#
+	def profile(self, seconds, mode="sample", filename=None):
+		"""
+		Profiles for that many seconds, then writes the results to filename.
+		Returns False if a profile is already running.
+		"""
+		if self.profiling:
+			return False
+		
+		if mode == "cprofile":
+			filename = filename or self.makeFilename("profile", "prof")
+			profiler = cProfile.Profile()
+			profiler.enable()
+			def stop():
+				profiler.disable()
+				profiler.dump_stats(filename)
+		else:
+			filename = filename or self.makeFilename("profile", "folded")
+			sampler = Sampler(self.INTERVAL)
+			sampler.start()
+			def stop():
+				sampler.stop()
+				sampler.write(filename)
+		
+		self.profiling = mode
+		def done():
+			self.profiling = None
+			stop()
+		self.callLater(seconds, done)
+		return True
+	
+	def callLater(self, seconds, callback):
+		pass # Implementors: call callback in that many seconds.
+
+class TwistedPensieve(Pensieve):
+	def callLater(self, seconds, callback):
+		reactor.callLater(seconds, callback)
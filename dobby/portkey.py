@@ -0,0 +1,541 @@
+# coding: utf-8
+"""
+Portkey takes Dobby somewhere else: onto trollius (asyncio's backport to Python 2,
+as Dobby is Python 2 code), instead of Twisted. Dolores, the dispatchers and the
+Firenze logic are the same; what is here are the servers:
+
+* AsyncioFirenzeServer: long polls and streams, with AsyncioFirenzeManager, which
+  makes AsyncioFirenzes. Their timers are the manager's TimingWheel, or the loop's.
+* AsyncioDudleyServer: Dudley's JSON POSTs (see receiveCommands in dudley.py).
+* AsyncioImperioServer and AsyncioHTTPImperioServer: Imperio, over TCP and HTTP.
+* AsyncioFlooServer: Floo.
+* AsyncioMarauderServer: the metrics.
+* AsyncioPensieve, for profiles timed by the loop, and callEvery, for anything that
+  needs doing now and then (like Twisted's LoopingCall).
+
+Each listens as soon as it is made, and adds the loop's run_forever to Dolores's
+starters. Like the Twisted servers, they listen on every interface (all but the
+Marauder's, which listens on host only).
+
+The HTTP servers share a small HTTP/1.1 connection (AsyncioHTTPConnection), rather
+than a full web framework: requests are parsed into a dictionary of headers, and a
+response is a single write. Connections are kept alive, and pipelined requests are
+answered in order. While a long poll waits, the connection costs its protocol object
+and its Firenze; there is no request object, and its idle timer is only looked at
+once every IDLE_TIMEOUT seconds. Run benchmarks/pipeline.py with --backend to compare.
+
+Twisted is still imported (by the modules shared with the Twisted servers), but
+its reactor is never run.
+"""
+import urllib
+import urlparse
+
+import trollius as asyncio
+
+try:
+	import simplejson as json
+except:
+	import json
+
+from firenze import Firenze, FirenzeManager, chooseEncoding
+from dudley import receiveCommands, countInterest
+from imperio import Imperio, httpDate
+from floo import Floo
+from pensieve import Pensieve
+
+SERVER = "Firenze instance, probably on Dolores."
+
+def callEvery(interval, function, loop=None):
+	"""
+	Calls function every interval seconds, starting interval seconds from now.
+	"""
+	loop = loop or asyncio.get_event_loop()
+	due = [loop.time() + interval]
+	def call():
+		due[0] = max(due[0] + interval, loop.time())
+		loop.call_at(due[0], call)
+		function()
+	loop.call_at(due[0], call)
+
+def callSoon(function, loop=None):
+	"""
+	Calls function once the current pass of the event loop is over.
+	"""
+	(loop or asyncio.get_event_loop()).call_soon(function)
+
+class AsyncioServer(object):
+	"""
+	Listens on port, with a connection (a Protocol class, made with the server) for
+	each client.
+	"""
+	def __init__(self, dolores, connection, host=None, port=None, loop=None):
+		self.dolores = dolores
+		self.loop = loop or asyncio.get_event_loop()
+		self.connection = connection
+		self.server = self.loop.run_until_complete(
+			self.loop.create_server(lambda: connection(self), host, port))
+		dolores.addStarter(self.loop.run_forever)
+
+class AsyncioHTTPConnection(asyncio.Protocol):
+	"""
+	A small HTTP/1.1 server connection. Subclasses answer each request in
+	handleRequest, then or later, with respond() (or by writing the response and
+	calling finishResponse()). Requests that come in the meantime wait their turn.
+	"""
+	MAX_HEADERS = 64 * 1024
+	MAX_BODY = 16 * 1024 * 1024
+	
+	def __init__(self, server):
+		self.server = server
+		self.loop = server.loop
+		self.transport = None
+		self.received = []
+		self.receivedBytes = 0
+		self.needed = 0
+		self.busy = False
+		self.processing = False
+		self.version = None
+		self.keepAlive = False
+		self.lastActivity = 0
+		self.idleTimer = None
+	
+	def connection_made(self, transport):
+		self.transport = transport
+		self.lastActivity = self.loop.time()
+		if self.server.IDLE_TIMEOUT:
+			self.idleTimer = self.loop.call_later(self.server.IDLE_TIMEOUT, self.checkIdle)
+	
+	def checkIdle(self):
+		idle = self.loop.time() - self.lastActivity
+		if self.busy:
+			idle = 0
+		if idle < self.server.IDLE_TIMEOUT:
+			self.idleTimer = self.loop.call_later(self.server.IDLE_TIMEOUT - idle, self.checkIdle)
+			return
+		self.idleTimer = None
+		self.close()
+	
+	def data_received(self, data):
+		self.lastActivity = self.loop.time()
+		self.received.append(data)
+		self.receivedBytes += len(data)
+		if not self.busy and self.receivedBytes >= self.needed:
+			self.processBuffer()
+	
+	def connection_lost(self, exc):
+		if self.idleTimer:
+			self.idleTimer.cancel()
+			self.idleTimer = None
+		self.transport = None
+		self.lost()
+	
+	def lost(self):
+		pass # Subclasses: the client went away.
+	
+	def processBuffer(self):
+		"""
+		Handles every complete request received, until one is not answered at once.
+		"""
+		buffer = "".join(self.received)
+		offset = 0
+		self.processing = True
+		try:
+			while not self.busy and self.transport:
+				# Blank lines between requests are allowed
+				while buffer.startswith("\r\n", offset):
+					offset += 2
+				end = buffer.find("\r\n\r\n", offset)
+				if end < 0:
+					if len(buffer) - offset > self.MAX_HEADERS:
+						self.close()
+					self.needed = len(buffer) - offset + 1
+					break
+				
+				lines = buffer[offset:end].split("\r\n")
+				request = lines[0].split(" ")
+				headers = {}
+				for line in lines[1:]:
+					name, colon, value = line.partition(":")
+					headers[name.strip().lower()] = value.strip()
+				try:
+					length = int(headers.get("content-length") or 0)
+				except ValueError:
+					length = -1
+				if len(request) != 3 or length < 0 or length > self.MAX_BODY:
+					self.close()
+					break
+				start = end + 4
+				if len(buffer) < start + length:
+					self.needed = start + length - offset
+					break
+				body = buffer[start:start + length]
+				offset = start + length
+				
+				method, target, version = request
+				connection = headers.get("connection", "").lower()
+				if version == "HTTP/1.0":
+					self.keepAlive = connection == "keep-alive"
+				else:
+					self.keepAlive = connection != "close"
+				self.version = version
+				self.busy = True
+				self.needed = 0
+				self.handleRequest(method, target, headers, body)
+		finally:
+			self.processing = False
+		
+		rest = buffer[offset:]
+		self.received = [rest] if rest else []
+		self.receivedBytes = len(rest)
+	
+	def handleRequest(self, method, target, headers, body):
+		self.respond("405 Method Not Allowed", "")
+	
+	def respond(self, status, body, headers=()):
+		"""
+		Sends a whole response. headers is a sequence of (name, value).
+		"""
+		if not self.transport:
+			return
+		response = ["HTTP/1.1 ", status, "\r\nDate: ", httpDate(), "\r\nServer: ", SERVER,
+			"\r\nContent-Length: ", str(len(body)), "\r\n"]
+		for name, value in headers:
+			response.extend((name, ": ", value, "\r\n"))
+		response.append("Connection: keep-alive\r\n\r\n" if self.keepAlive else "Connection: close\r\n\r\n")
+		response.append(body)
+		self.transport.write("".join(response))
+		self.finishResponse()
+	
+	def finishResponse(self):
+		"""
+		Called once a response was written: goes on to the next request, if any.
+		"""
+		self.busy = False
+		self.lastActivity = self.loop.time()
+		if not self.transport:
+			return
+		if not self.keepAlive:
+			self.close()
+			return
+		if self.received and not self.processing:
+			self.processBuffer()
+	
+	def close(self):
+		"""
+		Closes the connection, once whatever was written is sent.
+		"""
+		if self.transport:
+			self.transport.close()
+			self.transport = None
+	
+	def write(self, what):
+		if self.transport:
+			self.transport.write(what)
+
+class AsyncioFirenze(Firenze):
+	def __init__(self, manager):
+		Firenze.__init__(self, manager)
+		self.connection = None
+		self.encoding = None
+	
+	def supplyConnection(self, connection, streaming=None, encoding=None):
+		"""
+		connection is an AsyncioFirenzeConnection; encoding is the Content-Encoding
+		to compress the response with, if any.
+		"""
+		self.connection = connection
+		self.encoding = encoding
+		connection.firenze = self
+		if streaming:
+			connection.startStream(streaming)
+		self.readyToSend(streaming)
+	
+	def release(self):
+		connection = self.connection
+		if connection:
+			connection.firenze = None
+			self.connection = None
+		return connection
+	
+	def send(self, headers, data):
+		if self.streaming:
+			self.connection.writeChunk("".join(data))
+			return
+		
+		connection = self.release()
+		if self.encoding:
+			length = 0
+			for piece in data:
+				length += len(piece)
+			if length >= self.manager.COMPRESS_MIN_SIZE:
+				# Only the last two pieces (the reconnectWith) are this client's own
+				body = self.manager.compress(self.encoding, data[:-2], data[-2:])
+				connection.respond("200 OK", body, (("Content-Type", "application/json"),
+					("Content-Encoding", self.encoding), ("Vary", "Accept-Encoding")))
+				return
+		connection.respondWith(headers, data)
+	
+	def finish(self):
+		connection = self.release()
+		if connection:
+			connection.endStream()
+	
+	def connectionClosed(self, connection):
+		if connection is self.connection:
+			self.release()
+			self.connectionLost()
+	
+	def callLater(self, duration, callback):
+		if self.manager.wheel is not None:
+			return self.manager.wheel.schedule(duration, callback)
+		return self.manager.loop.call_later(duration, callback)
+
+class AsyncioFirenzeManager(FirenzeManager):
+	def __init__(self, dolores, loop=None, **options):
+		FirenzeManager.__init__(self, dolores, **options)
+		self.loop = loop or asyncio.get_event_loop()
+	
+	def makeFirenze(self):
+		return AsyncioFirenze(self)
+	
+	def callSoon(self, callback):
+		self.loop.call_soon(callback)
+
+class AsyncioFirenzeConnection(AsyncioHTTPConnection):
+	STREAMS = ("chunked", "sse")
+	
+	def __init__(self, server):
+		AsyncioHTTPConnection.__init__(self, server)
+		self.firenze = None
+		self.vary = False
+		self.chunked = False
+	
+	def handleRequest(self, method, target, headers, body):
+		if method != "GET":
+			self.respond("405 Method Not Allowed", "")
+			return
+		manager = self.server.manager
+		path, question, query = target.partition("?")
+		uid = urllib.unquote(path.strip("/"))
+		streaming = None
+		if self.server.allowStreaming:
+			streaming = urlparse.parse_qs(query).get("stream", [None])[0]
+			if not streaming in self.STREAMS:
+				streaming = None
+		encoding = None
+		self.vary = False
+		if not streaming and manager.COMPRESS_MIN_SIZE is not None:
+			encoding = chooseEncoding(headers.get("accept-encoding"))
+			self.vary = True
+		try:
+			if uid.strip() == "":
+				manager.beginNewSession(self, streaming, encoding=encoding)
+			else:
+				manager.resumeSession(uid, self, streaming, encoding)
+		except ValueError:
+			# A reconnectWith that isn't one
+			if not self.firenze:
+				self.respond("400 Bad Request", "")
+	
+	def respondWith(self, headers, data):
+		"""
+		Sends a long poll's response: the headers Firenze made, and the data.
+		"""
+		if not self.transport:
+			return
+		extra = "Vary: Accept-Encoding\r\n" if self.vary else ""
+		extra += "Connection: keep-alive\r\n\r\n" if self.keepAlive else "Connection: close\r\n\r\n"
+		self.transport.write(headers[:-2] + extra)
+		self.transport.writelines(data)
+		self.finishResponse()
+	
+	def startStream(self, streaming):
+		headers = ["HTTP/1.1 200 OK\r\nDate: ", httpDate(), "\r\nServer: ", SERVER, "\r\n"]
+		if streaming == "sse":
+			headers.append("Content-Type: text/event-stream\r\nCache-Control: no-cache\r\n")
+		else:
+			headers.append("Content-Type: application/json\r\n")
+		headers.append("X-Accel-Buffering: no\r\n")
+		# HTTP/1.0 has no chunks, so the stream ends with the connection
+		self.chunked = self.version != "HTTP/1.0"
+		if self.chunked:
+			headers.append("Transfer-Encoding: chunked\r\n")
+		else:
+			self.keepAlive = False
+		headers.append("Connection: keep-alive\r\n\r\n" if self.keepAlive else "Connection: close\r\n\r\n")
+		self.transport.write("".join(headers))
+	
+	def writeChunk(self, data):
+		if not self.transport:
+			return
+		if self.chunked:
+			self.transport.write("%x\r\n%s\r\n" % (len(data), data))
+		else:
+			self.transport.write(data)
+	
+	def endStream(self):
+		if self.chunked and self.transport:
+			self.transport.write("0\r\n\r\n")
+		self.finishResponse()
+	
+	def lost(self):
+		if self.firenze:
+			self.firenze.connectionClosed(self)
+
+class AsyncioFirenzeServer(AsyncioServer):
+	def __init__(self, dolores, host="localhost", port=8008, log=None, TIMER_TICK=.05, allowStreaming=True,
+			IDLE_TIMEOUT=60, loop=None, **options):
+		"""
+		As TwistedFirenzeServer. Connections with no request waiting are closed
+		after IDLE_TIMEOUT seconds.
+		"""
+		loop = loop or asyncio.get_event_loop()
+		self.manager = AsyncioFirenzeManager(dolores, loop, log=log, TIMER_TICK=TIMER_TICK, **options)
+		self.host = host
+		self.port = port
+		self.allowStreaming = allowStreaming
+		self.IDLE_TIMEOUT = IDLE_TIMEOUT
+		AsyncioServer.__init__(self, dolores, AsyncioFirenzeConnection, None, port, loop)
+		if self.manager.wheel is not None:
+			callEvery(TIMER_TICK, self.manager.wheel.advance, loop)
+
+class AsyncioDudleyConnection(AsyncioHTTPConnection):
+	def handleRequest(self, method, target, headers, body):
+		if method == "GET":
+			query = target.partition("?")[2]
+			self.respond("200 OK", countInterest(self.server.interest, urlparse.parse_qs(query).get("path", [])),
+				(("Content-Type", "application/json"),))
+		elif method == "POST":
+			self.respond("200 OK", receiveCommands(self.server.dolores, self, body),
+				(("Content-Type", "text/html"),))
+		else:
+			self.respond("405 Method Not Allowed", "")
+
+class AsyncioDudleyServer(AsyncioServer):
+	def __init__(self, dolores, receiver=None, host="localhost", port=8004, interest=None, IDLE_TIMEOUT=60,
+			loop=None):
+		if not receiver: receiver = dolores
+		self.receiver = receiver
+		self.interest = interest
+		self.host = host
+		self.port = port
+		self.IDLE_TIMEOUT = IDLE_TIMEOUT
+		AsyncioServer.__init__(self, dolores, AsyncioDudleyConnection, None, port, loop)
+
+class AsyncioImperioConnection(asyncio.Protocol):
+	"""
+	Imperio lines, ending in \\r\\n as for Twisted's LineReceiver.
+	"""
+	MAX_LENGTH = 16384
+	
+	def __init__(self, server):
+		self.server = server
+		self.transport = None
+		self.buffer = ""
+	
+	def connection_made(self, transport):
+		self.transport = transport
+		self.imperio = Imperio(self.server.receiver, self)
+	
+	def data_received(self, data):
+		lines = (self.buffer + data).split("\r\n")
+		self.buffer = lines.pop()
+		for line in lines:
+			if line == "::exit":
+				self.transport.close()
+				return
+			self.imperio.receiveLine(line)
+		if len(self.buffer) > self.MAX_LENGTH:
+			self.transport.close()
+	
+	def connection_lost(self, exc):
+		self.transport = None
+	
+	def write(self, what):
+		if self.transport:
+			self.transport.write(what)
+
+class AsyncioImperioServer(AsyncioServer):
+	def __init__(self, dolores, receiver=None, host="localhost", port=8007, loop=None):
+		if not receiver: receiver = dolores
+		self.receiver = receiver
+		self.host = host
+		self.port = port
+		AsyncioServer.__init__(self, dolores, AsyncioImperioConnection, None, port, loop)
+
+class AsyncioHTTPImperioConnection(AsyncioHTTPConnection):
+	"""
+	As TwistedHTTPImperioConnection: GET /path;message, or a POST of lines.
+	"""
+	def connection_made(self, transport):
+		AsyncioHTTPConnection.connection_made(self, transport)
+		self.imperio = Imperio(self.server.receiver, self)
+	
+	def handleRequest(self, method, target, headers, body):
+		if method == "GET":
+			self.imperio.receiveLine(urllib.unquote(target[1:]))
+		elif method == "POST":
+			for line in body.split("\n"):
+				line = line.rstrip("\r")
+				if line:
+					self.imperio.receiveLine(line)
+		else:
+			self.keepAlive = False
+		self.respond("200 OK", "{sent:true}", (("Content-Type", "application/json"),))
+
+class AsyncioHTTPImperioServer(AsyncioServer):
+	def __init__(self, dolores, receiver=None, host="localhost", port=8003, IDLE_TIMEOUT=60, loop=None):
+		if not receiver: receiver = dolores
+		self.receiver = receiver
+		self.host = host
+		self.port = port
+		self.IDLE_TIMEOUT = IDLE_TIMEOUT
+		AsyncioServer.__init__(self, dolores, AsyncioHTTPImperioConnection, None, port, loop)
+
+class AsyncioFlooConnection(asyncio.Protocol):
+	def __init__(self, server):
+		self.server = server
+		self.transport = None
+	
+	def connection_made(self, transport):
+		self.transport = transport
+		self.floo = Floo(self.server.receiver, self)
+	
+	def data_received(self, data):
+		if not self.floo.receiveData(data):
+			self.transport.close()
+	
+	def connection_lost(self, exc):
+		self.transport = None
+	
+	def write(self, what):
+		if self.transport:
+			self.transport.write(what)
+
+class AsyncioFlooServer(AsyncioServer):
+	def __init__(self, dolores, receiver=None, host="localhost", port=8005, loop=None):
+		if not receiver: receiver = dolores
+		self.receiver = receiver
+		self.host = host
+		self.port = port
+		AsyncioServer.__init__(self, dolores, AsyncioFlooConnection, None, port, loop)
+
+class AsyncioMarauderConnection(AsyncioHTTPConnection):
+	def handleRequest(self, method, target, headers, body):
+		if method != "GET":
+			self.respond("405 Method Not Allowed", "")
+			return
+		self.respond("200 OK", json.dumps(self.server.metrics.snapshot()),
+			(("Content-Type", "application/json"),))
+
+class AsyncioMarauderServer(AsyncioServer):
+	def __init__(self, dolores, metrics, host="localhost", port=8009, IDLE_TIMEOUT=60, loop=None):
+		self.metrics = metrics
+		self.host = host
+		self.port = port
+		self.IDLE_TIMEOUT = IDLE_TIMEOUT
+		AsyncioServer.__init__(self, dolores, AsyncioMarauderConnection, host, port, loop)
+
+class AsyncioPensieve(Pensieve):
+	def callLater(self, seconds, callback):
+		asyncio.get_event_loop().call_later(seconds, callback)
@@ -0,0 +1,113 @@
+# coding: utf-8
+"""
+The Remembrall remembers the latest message on each path, so that a client that
+connects (or reconnects) to a path can be sent its current state straight away,
+rather than having to ask the backend for it.
+
+It is bounded three ways: MAX_ENTRIES paths and MAX_BYTES of paths and messages
+at most, the least recently used going first once either is passed; and messages
+older than MAX_AGE seconds are not recalled (0 means no limit for any of them).
+Expired messages are dropped when recalled, or by prune().
+
+Only string messages are remembered; anything else (Dudley passes on numbers, say)
+makes the path forgotten, as what was remembered for it is no longer the latest.
+
+Pig (see owl.py) uses one if given it as cache.
+"""
+from collections import OrderedDict
+from time import time
+
+class Remembrall(object):
+	def __init__(self, MAX_ENTRIES=100000, MAX_BYTES=64 * 1024 * 1024, MAX_AGE=60 * 60):
+		self.MAX_ENTRIES = MAX_ENTRIES
+		self.MAX_BYTES = MAX_BYTES
+		self.MAX_AGE = MAX_AGE
+		
+		# path to (message, time), least recently used first
+		self.entries = OrderedDict()
+		self.bytes = 0
+		
+		self.hits = 0
+		self.misses = 0
+		self.evicted = 0
+	
+	def __len__(self):
+		return len(self.entries)
+	
+	def wants(self, path):
+		"""
+		Whether the latest message on the path is remembered. Commands (paths
+		starting with "::") are not.
+		"""
+		return not path.startswith("::")
+	
+	def remember(self, path, message):
+		if not isinstance(message, basestring):
+			self.forget(path)
+			return
+		if isinstance(path, unicode):
+			path = path.encode("utf-8")
+		if isinstance(message, unicode):
+			message = message.encode("utf-8")
+		
+		entries = self.entries
+		old = entries.pop(path, None)
+		if old is not None:
+			self.bytes -= len(path) + len(old[0])
+		entries[path] = (message, time())
+		self.bytes += len(path) + len(message)
+		
+		# Make room, least recently used first
+		while entries and ((self.MAX_ENTRIES and len(entries) > self.MAX_ENTRIES) or
+				(self.MAX_BYTES and self.bytes > self.MAX_BYTES)):
+			self.drop(next(iter(entries)))
+			self.evicted += 1
+	
+	def recall(self, path):
+		"""
+		Returns the latest message on the path, or None if there is none (or it
+		has expired).
+		"""
+		if isinstance(path, unicode):
+			path = path.encode("utf-8")
+		entry = self.entries.pop(path, None)
+		if entry is None:
+			self.misses += 1
+			return None
+		if self.MAX_AGE and time() - entry[1] > self.MAX_AGE:
+			self.bytes -= len(path) + len(entry[0])
+			self.misses += 1
+			return None
+		
+		# Now the most recently used
+		self.entries[path] = entry
+		self.hits += 1
+		return entry[0]
+	
+	def forget(self, path):
+		if isinstance(path, unicode):
+			path = path.encode("utf-8")
+		if path in self.entries:
+			self.drop(path)
+	
+	def drop(self, path):
+		message, stamp = self.entries.pop(path)
+		self.bytes -= len(path) + len(message)
+	
+	def prune(self):
+		"""
+		Drops every message older than MAX_AGE.
+		"""
+		if not self.MAX_AGE:
+			return
+		oldest = time() - self.MAX_AGE
+		for path, (message, stamp) in self.entries.items():
+			if stamp < oldest:
+				self.drop(path)
+	
+	def snapshot(self):
+		"""
+		For the Marauder's Map.
+		"""
+		return {"paths": len(self.entries), "bytes": self.bytes, "hits": self.hits,
+			"misses": self.misses, "evicted": self.evicted}
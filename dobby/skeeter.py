@@ -0,0 +1,170 @@
+# coding: utf-8
+"""
+Skeeter writes down everything Dolores receives, like Logger (in imperio.py) does.
+
+The difference is that Dolores doesn't wait for her. Logger writes and flushes each
+update as it goes by, before the dispatcher even sees it; Skeeter only notes the update
+down in a buffer, and a thread of her own formats and writes the buffer out every
+FLUSH_INTERVAL seconds.
+
+She is also choosier than Logger:
+* paths and exclude are lists of paths or patterns (as for Pig) to log, or not to log.
+* SAMPLE is the fraction of the remaining updates to log (1 logs them all).
+* The buffer holds at most MAX_BUFFER updates. If the thread can't keep up, further
+  updates are not logged (and counted in dropped) rather than piling up in memory.
+
+Updates are written one per line, either as Logger does ("text") or as JSON objects
+with the time, sender id, path and message ("json"). If f is a file name rather than
+a file, the file is rotated once it grows past MAX_BYTES: file becomes file.1, file.1
+becomes file.2, and so on, keeping BACKUPS of them.
+
+An update that can't be formatted, or a write that fails, is reported and counted in
+errors; the thread goes on with the rest.
+"""
+import atexit
+import os
+import random
+import sys
+import threading
+import traceback
+from collections import deque
+from time import time
+from thestral import Thestral
+from owl import SubscriptionIndex
+
+try:
+	import simplejson as json
+except:
+	import json
+
+class Skeeter(Thestral):
+	def __init__(self, f=sys.stdout, format="text", FLUSH_INTERVAL=.5, MAX_BUFFER=100000,
+			SAMPLE=1, paths=None, exclude=None, MAX_BYTES=None, BACKUPS=5):
+		self.id = "SKEETER"
+		self.format = format
+		self.FLUSH_INTERVAL = FLUSH_INTERVAL
+		self.MAX_BUFFER = MAX_BUFFER
+		self.SAMPLE = SAMPLE
+		self.MAX_BYTES = MAX_BYTES
+		self.BACKUPS = BACKUPS
+		
+		self.paths = self.makeIndex(paths)
+		self.exclude = self.makeIndex(exclude)
+		
+		self.buffer = deque()
+		self.dropped = 0
+		self.written = 0
+		self.errors = 0
+		
+		if isinstance(f, basestring):
+			self.filename = f
+			self.file = open(f, "a")
+			self.size = self.file.tell()
+		else:
+			self.filename = None
+			self.file = f
+			self.size = 0
+		
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self.run, name="Skeeter")
+		self.thread.daemon = True
+		self.thread.start()
+		atexit.register(self.close)
+	
+	def makeIndex(self, patterns):
+		if not patterns:
+			return None
+		index = SubscriptionIndex()
+		for pattern in patterns:
+			index.add(pattern, self)
+		return index
+	
+	def update(self, sender, path, message):
+		"""
+		Notes the update down, if it is to be logged. This is all the work done
+		while Dolores waits.
+		"""
+		if self.paths and not self.paths.match(path):
+			return
+		if self.exclude and self.exclude.match(path):
+			return
+		if self.SAMPLE < 1 and random.random() >= self.SAMPLE:
+			return
+		if len(self.buffer) >= self.MAX_BUFFER:
+			self.dropped += 1
+			return
+		self.buffer.append((time(), getattr(sender, "id", None), path, message))
+	
+	def run(self):
+		while not self.stopped.is_set():
+			self.stopped.wait(self.FLUSH_INTERVAL)
+			self.flush()
+	
+	def flush(self):
+		"""
+		Writes out whatever is in the buffer. Called from Skeeter's own thread.
+		"""
+		buffer = self.buffer
+		if not buffer:
+			return
+		
+		lines = []
+		while buffer:
+			record = buffer.popleft()
+			try:
+				lines.append(self.formatRecord(*record))
+			except Exception:
+				self.errors += 1
+				traceback.print_exc()
+		if not lines:
+			return
+		
+		data = "".join(lines)
+		try:
+			self.file.write(data)
+			self.file.flush()
+			self.written += len(lines)
+			self.size += len(data)
+			if self.filename and self.MAX_BYTES and self.size >= self.MAX_BYTES:
+				self.rotate()
+		except Exception:
+			self.errors += len(lines)
+			traceback.print_exc()
+	
+	def formatRecord(self, stamp, sender, path, message):
+		"""
+		Returns the line for an update, as UTF-8 bytes.
+		"""
+		if self.format == "json":
+			return json.dumps({"time": stamp, "sender": sender, "path": path, "message": message}) + "\n"
+		return self.toBytes(path) + "; " + self.toBytes(message) + "\n"
+	
+	def toBytes(self, value):
+		if isinstance(value, unicode):
+			return value.encode("utf-8")
+		if isinstance(value, str):
+			return value
+		return json.dumps(value)
+	
+	def rotate(self):
+		self.file.close()
+		for i in range(self.BACKUPS - 1, 0, -1):
+			name = "%s.%d" % (self.filename, i)
+			if os.path.exists(name):
+				os.rename(name, "%s.%d" % (self.filename, i + 1))
+		if self.BACKUPS > 0:
+			os.rename(self.filename, self.filename + ".1")
+		else:
+			os.remove(self.filename)
+		self.file = open(self.filename, "a")
+		self.size = 0
+	
+	def close(self):
+		"""
+		Stops the thread and writes out what is left.
+		"""
+		if self.stopped.is_set():
+			return
+		self.stopped.set()
+		self.thread.join()
+		self.flush()